@@ -0,0 +1,276 @@
+import argparse
+import asyncio
+import json
+import random
+import struct
+from time import perf_counter_ns
+
+import websockets
+
+# Load generator speaking the same wire format as src/lib/client.ts. Receivers take the lowest client
+# ids and either subscribe, poll with GET or poll with GETBATCH, senders PUSH to them at a fixed rate.
+# Every payload carries the time it was sent so that delivery latency can be measured end to end.
+# With --flow-control senders keep up to --window PUSHes in flight, bounded by the credits the server
+# advertises for the receiver. With --request-ids every request is tagged and responses are matched by
+# id instead of by order. Client ids are a single byte, so at most 256 clients can be associated.
+
+PAYLOAD = struct.Struct("!Q")  # Send time in nanoseconds, padded up to --length bytes
+
+SUBSCRIBE = 1 << 0
+FLOWCONTROL = 1 << 1
+REQUEST_ID = 1 << 7
+
+
+class Stats:
+    def __init__(self):
+        self.pushes = 0
+        self.acks = 0
+        self.buffer_full = 0
+        self.errors = 0
+        self.gets = 0
+        self.empty = 0
+        self.latencies = []  # Nanoseconds
+
+
+class Client:
+    def __init__(self, client_id, websocket, stats, request_ids):
+        self.client_id = client_id
+        self.websocket = websocket
+        self.stats = stats
+
+        self.request_ids = request_ids
+        self.next_request_id = 0
+
+        self.pending = []  # Futures waiting for a response, the server answers in order
+        self.tagged = {}  # {request_id: future}, when requests are tagged
+        self.credits = {}  # {receiver_id: credits}, last advertised by the server
+        self.reader = asyncio.create_task(self.read())
+
+    async def read(self):
+        async for message in self.websocket:
+            if message[0] & REQUEST_ID:
+                response = bytearray(message[:-1])
+                response[0] &= ~REQUEST_ID
+                self.tagged.pop(message[-1]).set_result(response)
+            elif message[0] == 2 and message[1] == 0 and not self.pending:
+                self.deliver(message)  # Pushed GETRESPONSE
+            elif self.pending:
+                self.pending.pop(0).set_result(message)
+
+    async def request(self, packet):
+        future = asyncio.get_running_loop().create_future()
+        if self.request_ids:
+            request_id = self.next_request_id
+            while request_id in self.tagged:
+                request_id = (request_id + 1) % 256
+
+            self.next_request_id = (request_id + 1) % 256
+            self.tagged[request_id] = future
+
+            packet = bytearray(packet)
+            packet[0] |= REQUEST_ID
+            packet.append(request_id)
+        else:
+            self.pending.append(future)
+
+        await self.websocket.send(packet)
+        return await future
+
+    def deliver(self, message):
+        received_at = perf_counter_ns()
+        if message[1] == 0:  # GETRESPONSE
+            self.stats.latencies.append(received_at - PAYLOAD.unpack_from(message, 5)[0])
+        else:  # BATCHRESPONSE
+            offset = 4
+            for _ in range(message[3]):
+                self.stats.latencies.append(
+                    received_at - PAYLOAD.unpack_from(message, offset + 2)[0]
+                )
+                offset += 2 + message[offset + 1]
+
+    async def associate(self, flags):
+        packet = struct.pack("!BBB", 0, 0, self.client_id)
+        if flags:
+            packet += bytes([flags])
+
+        response = await self.request(packet)
+        if response[:2] != b"\x00\x01":
+            raise RuntimeError(f"Client {self.client_id} failed to associate")
+
+    async def push(self, receiver_id, length):
+        payload = PAYLOAD.pack(perf_counter_ns()).ljust(length, b"\x00")
+        packet = struct.pack("!BBBBB", 2, 1, self.client_id, receiver_id, len(payload))
+
+        self.stats.pushes += 1
+        response = await self.request(packet + payload)
+        if len(response) > 3:
+            self.credits[receiver_id] = response[3]
+
+        if response[:2] == b"\x01\x02":
+            self.stats.acks += 1
+        elif response[:2] == b"\x01\x03":
+            self.stats.buffer_full += 1
+        else:
+            self.stats.errors += 1
+
+    async def get(self, batch):
+        if batch:
+            packet = struct.pack("!BBBB", 1, 4, self.client_id, batch)
+        else:
+            packet = struct.pack("!BBB", 1, 0, self.client_id)
+
+        self.stats.gets += 1
+        response = await self.request(packet)
+        if response[0] == 2:
+            self.deliver(response)
+            return True
+
+        if response[:2] == b"\x01\x01":
+            self.stats.empty += 1
+        else:
+            self.stats.errors += 1
+
+        return False
+
+
+async def run_sender(client, receivers, args, deadline):
+    interval = 1 / args.rate
+    next_send = perf_counter_ns()
+
+    in_flight = set()
+    while perf_counter_ns() < deadline:
+        if args.pattern == "single":
+            receiver_id = 0
+        else:
+            receiver_id = random.randrange(receivers)
+
+        # Never more in flight than the receiver was last known to have room for, but always at least one
+        window = max(1, min(args.window, client.credits.get(receiver_id, args.window)))
+        while len(in_flight) >= window:
+            _, in_flight = await asyncio.wait(
+                in_flight, return_when=asyncio.FIRST_COMPLETED
+            )
+
+        in_flight.add(asyncio.create_task(client.push(receiver_id, args.length)))
+
+        # Scheduled against absolute times so that slow responses do not lower the offered load
+        next_send += int(interval * 1e9)
+        delay = (next_send - perf_counter_ns()) / 1e9
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    if in_flight:
+        await asyncio.wait(in_flight)
+
+
+async def run_receiver(client, args, deadline):
+    if args.delivery == "push":
+        return
+
+    batch = args.batch if args.delivery == "batch" else 0
+    while perf_counter_ns() < deadline:
+        while await client.get(batch):
+            pass
+
+        await asyncio.sleep(args.poll_interval)
+
+
+def quantile(values, q):
+    if not values:
+        return None
+
+    return values[min(len(values) - 1, int(q * len(values)))] / 1e6
+
+
+async def main(args):
+    if args.senders + args.receivers > 256:
+        raise SystemExit("Client ids are a single byte, at most 256 clients are supported")
+
+    stats = Stats()
+    client_ids = range(args.senders + args.receivers)
+
+    connections = [await websockets.connect(args.url) for _ in client_ids]
+    clients = [
+        Client(client_id, websocket, stats, args.request_ids)
+        for client_id, websocket in zip(client_ids, connections)
+    ]
+
+    receivers = clients[: args.receivers]
+    senders = clients[args.receivers :]
+
+    for client in receivers:
+        await client.associate(SUBSCRIBE if args.delivery == "push" else 0)
+    for client in senders:
+        await client.associate(FLOWCONTROL if args.flow_control else 0)
+
+    started_at = perf_counter_ns()
+    deadline = started_at + int(args.duration * 1e9)
+
+    await asyncio.gather(
+        *(run_sender(client, args.receivers, args, deadline) for client in senders),
+        *(run_receiver(client, args, deadline) for client in receivers),
+    )
+    elapsed = (perf_counter_ns() - started_at) / 1e9
+
+    # Whatever is still in flight after this is not counted
+    await asyncio.sleep(args.drain)
+
+    for websocket in connections:
+        await websocket.close()
+
+    latencies = sorted(stats.latencies)
+    return {
+        "config": vars(args),
+        "elapsed": elapsed,
+        "pushes": stats.pushes,
+        "acks": stats.acks,
+        "buffer_full": stats.buffer_full,
+        "buffer_full_rate": stats.buffer_full / stats.pushes if stats.pushes else 0,
+        "errors": stats.errors,
+        "gets": stats.gets,
+        "empty": stats.empty,
+        "delivered": len(latencies),
+        "push_throughput": stats.pushes / elapsed,
+        "delivery_throughput": len(latencies) / elapsed,
+        "latency_ms": {
+            "p50": quantile(latencies, 0.5),
+            "p99": quantile(latencies, 0.99),
+            "p999": quantile(latencies, 0.999),
+            "max": latencies[-1] / 1e6 if latencies else None,
+        },
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="ws://localhost:12345")
+    parser.add_argument("--senders", type=int, default=192)
+    parser.add_argument("--receivers", type=int, default=64)
+    parser.add_argument("--rate", type=float, default=50, help="PUSHes per second per sender")
+    parser.add_argument("--length", type=int, default=64, help="payload bytes, at least 8")
+    parser.add_argument("--pattern", choices=("uniform", "single"), default="uniform")
+    parser.add_argument("--delivery", choices=("push", "get", "batch"), default="push")
+    parser.add_argument("--batch", type=int, default=64)
+    parser.add_argument("--flow-control", action="store_true")
+    parser.add_argument("--window", type=int, default=1, help="PUSHes in flight per sender")
+    parser.add_argument("--request-ids", action="store_true")
+    parser.add_argument("--poll-interval", type=float, default=0.1)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--drain", type=float, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="file to append the JSON result to")
+    args = parser.parse_args()
+
+    if not PAYLOAD.size <= args.length < 255:
+        parser.error(f"--length must be between {PAYLOAD.size} and 254")
+    if args.request_ids and args.window > 256:
+        parser.error("--window can be at most 256 with --request-ids")
+
+    random.seed(args.seed)
+    result = json.dumps(asyncio.run(main(args)))
+
+    if args.output is None:
+        print(result)
+    else:
+        with open(args.output, "a") as file:
+            print(result, file=file)
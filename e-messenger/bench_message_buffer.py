@@ -0,0 +1,47 @@
+import argparse
+from collections import deque
+from timeit import timeit
+
+# Compares the old list mailboxes against the deques push_message now uses, for a full buffer being
+# drained and refilled, which is what a receiver under heavy fan-in looks like. Both check the
+# capacity inline, as push_message does
+
+MESSAGE = bytes([1, 2, 5]) + b"hello"
+
+
+def churn_list(capacity, rounds):
+    buffer = []
+    for _ in range(capacity):
+        buffer.append(MESSAGE)
+
+    for _ in range(rounds):
+        buffer.pop(0)
+        if len(buffer) < capacity:
+            buffer.append(MESSAGE)
+
+
+def churn_deque(capacity, rounds):
+    buffer = deque()
+    for _ in range(capacity):
+        buffer.append(MESSAGE)
+
+    for _ in range(rounds):
+        buffer.popleft()
+        if len(buffer) < capacity:
+            buffer.append(MESSAGE)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'capacity':>10} {'list (ns/op)':>14} {'deque (ns/op)':>14}")
+    for capacity in (100, 1_000, 10_000, 100_000):
+        ops = args.rounds * args.repeat
+
+        old = timeit(lambda: churn_list(capacity, args.rounds), number=args.repeat)
+        new = timeit(lambda: churn_deque(capacity, args.rounds), number=args.repeat)
+
+        print(f"{capacity:>10} {old / ops * 1e9:>14.1f} {new / ops * 1e9:>14.1f}")
@@ -0,0 +1,118 @@
+import argparse
+import array
+import struct
+import tracemalloc
+from statistics import median
+from time import perf_counter
+
+import server
+
+# Measures what a single message costs between PUSH and GET, for the copying path the server used to
+# have and for the current one. Peak is the largest amount of memory allocated at once while handling
+# a single packet (ignoring the first one, which allocates the buffer itself), retained is what stays
+# allocated per buffered message. The largest peak is when the buffer itself grows, a list by a share
+# of its length and a deque by a block of 64 slots, so the median peak of a push is shown as well.
+
+
+def baseline_push(buffer, message):
+    payload = message[5:]
+    if message[4] == len(payload):
+        buffer.append(message[2:])
+
+    return struct.pack("!BBB", 1, 2, message[2])  # POSITIVEACK
+
+
+def baseline_get(buffer, client_id):
+    message_payload = buffer.pop(0)
+    sender_id = message_payload[0]
+    message_payload = message_payload[3:]
+    return (
+        struct.pack("!BBBBB", 2, 0, client_id, sender_id, len(message_payload))
+        + message_payload
+    )  # GETRESPONSE
+
+
+def current_push(buffer, message):
+    if message[4] == len(message) - 5:
+        server.push_message(message[3], message)
+
+    return server.tag(server.POSITIVEACK[message[2]], None)
+
+
+def current_get(buffer, client_id):
+    return server.tag(server.pop_message(client_id), None)
+
+
+def measure(push, get, messages, receiver_id):
+    buffer = []
+    server.buffers.clear()
+
+    tracemalloc.start()
+
+    push_peaks = array.array("q", bytes(8 * (len(messages) - 1)))  # Allocated before counting
+    before = tracemalloc.get_traced_memory()[0]
+    started_at = perf_counter()
+    for index, message in enumerate(messages):
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        push(buffer, message)
+        if index > 0:
+            push_peaks[index - 1] = tracemalloc.get_traced_memory()[1] - current
+    push_time = perf_counter() - started_at
+    retained = tracemalloc.get_traced_memory()[0] - before
+
+    get_peak = 0
+    started_at = perf_counter()
+    for index in range(len(messages)):
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        get(buffer, receiver_id)
+        if index < len(messages) - 1:
+            get_peak = max(get_peak, tracemalloc.get_traced_memory()[1] - current)
+    get_time = perf_counter() - started_at
+
+    tracemalloc.stop()
+
+    count = len(messages)
+    return (
+        max(push_peaks),
+        median(push_peaks),
+        get_peak,
+        retained / count,
+        push_time / count,
+        get_time / count,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=100)
+    parser.add_argument("--length", type=int, default=200)
+    args = parser.parse_args()
+
+    server.BUFFER_SIZE = args.count
+
+    sender_id, receiver_id = 1, 2
+    messages = [
+        struct.pack("!BBBBB", 2, 1, sender_id, receiver_id, args.length)
+        + bytes(args.length)
+        for _ in range(args.count)
+    ]
+
+    print(f"{args.count} messages of {args.length} bytes (tracemalloc timings are inflated)")
+    print(
+        f"{'path':>10} {'push peak (B)':>14} {'median (B)':>11} {'get peak (B)':>13}"
+        f" {'retained (B/msg)':>17}"
+        f" {'push (us)':>10} {'get (us)':>9}"
+    )
+    for name, push, get in (
+        ("baseline", baseline_push, baseline_get),
+        ("current", current_push, current_get),
+    ):
+        push_peak, push_median, get_peak, retained, push_time, get_time = measure(
+            push, get, messages, receiver_id
+        )
+        print(
+            f"{name:>10} {push_peak:>14} {push_median:>11.0f} {get_peak:>13} {retained:>17.1f}"
+            f" {push_time * 1e6:>10.2f} {get_time * 1e6:>9.2f}"
+        )
@@ -0,0 +1,151 @@
+import mmap
+import os
+import struct
+
+HEADER = struct.Struct("!QQQ")
+RECORD = struct.Struct("!H")
+INITIAL_SIZE = 1 << 16
+
+
+class DurableMessageBuffer:
+    # Append-only log of messages for a single receiver, memory-mapped so that it is bounded by disk
+    # rather than RAM and survives restarts. Consumed records at the front are reclaimed by compaction
+    # Used like the in-memory deques, through append, popleft and len
+    # File layout: (head: 8 bytes, tail: 8 bytes, count: 8 bytes) + records of (length: 2 bytes) + frame
+    # Frames end with `spare` bytes that are never stored, popped ones get them back zeroed
+    # Writes go to the page cache and the kernel writes them back, so they survive the process
+    # crashing but not the host. Only close() flushes, an msync per message would cost a disk write
+
+    __slots__ = ("capacity", "spare", "mm", "head", "tail", "count")
+
+    def __init__(self, path, capacity, spare=0):
+        self.capacity = capacity
+        self.spare = spare
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            is_new = os.fstat(fd).st_size < HEADER.size
+            if is_new:
+                os.ftruncate(fd, INITIAL_SIZE)
+
+            self.mm = mmap.mmap(fd, 0)  # Keeps its own copy of the descriptor
+        finally:
+            os.close(fd)
+
+        if is_new:
+            self.head = self.tail = HEADER.size
+            self.count = 0
+            self.sync()
+        else:
+            self.head, self.tail, self.count = HEADER.unpack_from(self.mm, 0)
+
+    def __len__(self):
+        return self.count
+
+    def full(self):
+        return self.count >= self.capacity
+
+    def append(self, frame):
+        if self.count >= self.capacity:
+            return False
+
+        length = len(frame) - self.spare
+        size = RECORD.size + length
+        if self.tail + size > len(self.mm):
+            self.reserve(size)
+
+        start = self.tail + RECORD.size
+        RECORD.pack_into(self.mm, self.tail, length)
+        self.mm[start : start + length] = memoryview(frame)[:length]
+
+        self.tail = start + length
+        self.count += 1
+        self.sync()
+
+        return True
+
+    def popleft(self):
+        if not self.count:
+            raise IndexError("pop from an empty buffer")
+
+        length = RECORD.unpack_from(self.mm, self.head)[0]
+        start = self.head + RECORD.size
+        end = start + length
+
+        # Copied once straight out of the map, the view is released before anything can resize it
+        with memoryview(self.mm) as mm:
+            frame = bytearray().join((mm[start:end], bytes(self.spare)))
+
+        self.head = end
+        self.count -= 1
+        if self.count:
+            self.sync()
+        else:
+            self.reset()
+
+        return frame
+
+    def pop_many(self, count):
+        popleft = self.popleft
+        return [popleft() for _ in range(min(count, self.count))]
+
+    def prepend(self, frames):
+        # Puts frames back in front of everything in the log, used to persist a receiver's in-memory
+        # messages which are always older than anything that was spilled to disk
+        spare = self.spare
+        size = sum(RECORD.size + len(frame) - spare for frame in frames)
+
+        shift = size - (self.head - HEADER.size)
+        if shift > 0:
+            if self.tail + shift > len(self.mm):
+                self.resize(self.tail + shift)
+
+            self.mm.move(self.head + shift, self.head, self.tail - self.head)
+            self.head += shift
+            self.tail += shift
+
+        offset = self.head - size
+        for frame in frames:
+            length = len(frame) - spare
+            RECORD.pack_into(self.mm, offset, length)
+            offset += RECORD.size
+
+            self.mm[offset : offset + length] = memoryview(frame)[:length]
+            offset += length
+
+        self.head -= size
+        self.count += len(frames)
+        self.sync()
+
+    def reserve(self, size):
+        # Compact once at least half of the used region has been consumed, otherwise grow
+        live = self.tail - self.head
+        if self.head - HEADER.size >= live:
+            self.mm.move(HEADER.size, self.head, live)
+            self.head = HEADER.size
+            self.tail = HEADER.size + live
+
+        if self.tail + size > len(self.mm):
+            self.resize(self.tail + size)
+
+    def resize(self, size):
+        new_size = len(self.mm)
+        while new_size < size:
+            new_size *= 2
+
+        self.mm.resize(new_size)
+
+    def reset(self):
+        # Everything has been consumed, give the disk space back
+        self.head = self.tail = HEADER.size
+        if len(self.mm) > INITIAL_SIZE:
+            self.mm.resize(INITIAL_SIZE)
+
+        self.sync()
+
+    def sync(self):
+        HEADER.pack_into(self.mm, 0, self.head, self.tail, self.count)
+
+    def close(self):
+        self.mm.flush()
+        self.mm.close()
@@ -0,0 +1,128 @@
+import asyncio
+from bisect import bisect_left
+
+# Minimal Prometheus style instrumentation. Recording a value is a dict or list increment, everything
+# is only formatted when /metrics is scraped so that it can stay on under full load.
+
+REGISTRY = []
+
+
+class Counter:
+    __slots__ = ("name", "documentation", "label", "names", "values")
+
+    def __init__(self, name, documentation, label=None, names=None):
+        # Values are keyed by anything hashable, names maps keys to label values when scraped.
+        # Without a label there is one value, keyed by None. With names, any other key counts as
+        # "unknown", so that keys taken from the wire cannot add series without bound
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self.names = names or {}
+        self.values = {}
+
+        REGISTRY.append(self)
+
+    def inc(self, key=None):
+        values = self.values
+        if key not in values and self.names and key not in self.names:
+            key = "unknown"
+
+        values[key] = values.get(key, 0) + 1
+
+    def collect(self, labels):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} counter"
+        if self.label is None:
+            yield f"{self.name}{{{labels.rstrip(',')}}} {self.values.get(None, 0)}"
+            return
+
+        for key, value in self.values.items():
+            name = self.names.get(key, key)
+            yield f'{self.name}{{{labels}{self.label}="{name}"}} {value}'
+
+
+class Histogram:
+    __slots__ = ("name", "documentation", "bounds", "counts", "sum")
+
+    def __init__(self, name, documentation, bounds):
+        self.name = name
+        self.documentation = documentation
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # Last one is +Inf
+        self.sum = 0
+
+        REGISTRY.append(self)
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def collect(self, labels):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+
+        total = 0
+        for bound, count in zip((*self.bounds, "+Inf"), self.counts):
+            total += count
+            yield f'{self.name}_bucket{{{labels}le="{bound}"}} {total}'
+
+        yield f"{self.name}_sum{{{labels.rstrip(',')}}} {self.sum}"
+        yield f"{self.name}_count{{{labels.rstrip(',')}}} {total}"
+
+
+class Gauge:
+    __slots__ = ("name", "documentation", "read")
+
+    def __init__(self, name, documentation, read):
+        # Only read when scraped
+        self.name = name
+        self.documentation = documentation
+        self.read = read
+
+        REGISTRY.append(self)
+
+    def collect(self, labels):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} gauge"
+        yield f"{self.name}{{{labels.rstrip(',')}}} {self.read()}"
+
+
+def render(labels=None):
+    # labels are added to every sample, e.g. {"shard": 0}
+    prefix = "".join(f'{key}="{value}",' for key, value in (labels or {}).items())
+    return "\n".join(line for metric in REGISTRY for line in metric.collect(prefix)) + "\n"
+
+
+async def sample_event_loop_lag(histogram, interval=0.1):
+    # How late a sleep wakes up is how long everything else on the loop is kept waiting
+    loop = asyncio.get_running_loop()
+    while True:
+        started_at = loop.time()
+        await asyncio.sleep(interval)
+        histogram.observe(max(0.0, loop.time() - started_at - interval))
+
+
+async def serve(port, labels=None, host="127.0.0.1"):
+    async def handle_request(reader, writer):
+        try:
+            request = await reader.readline()
+            while await reader.readline() not in (b"\r\n", b"\n", b""):
+                pass  # Headers are not needed
+
+            if request.split()[1:2] == [b"/metrics"]:
+                status, body = "200 OK", render(labels).encode()
+            else:
+                status, body = "404 Not Found", b"Not Found\n"
+
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                "Content-Type: text/plain; version=0.0.4\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n".encode()
+                + body
+            )
+            await writer.drain()
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle_request, host, port)
@@ -1,143 +1,700 @@
+import argparse
 import asyncio
+import multiprocessing
+import os
 import struct
-from collections import defaultdict
+import tempfile
+from time import perf_counter
 
 import websockets
 
+import metrics
+import shards
+from collections import deque
+
+from message_buffer import DurableMessageBuffer
+
+BUFFER_SIZE = 100  # Maximum number of messages buffered per receiver in memory
+DATA_DIR = None  # Directory of on-disk buffers, messages only live in memory when not set
+DURABLE_BUFFER_SIZE = 10_000_000  # Maximum number of messages buffered per receiver on disk
+FLOW_CONTROL_TIMEOUT = 1.0  # Seconds a flow controlled PUSH waits for room before BUFFERFULL
+PUSH_BATCH = 32  # Messages a subscriber fetches from another worker at a time
+LEASE = 8  # Messages set aside for another worker to push to a receiver without asking, see shards.py
+SHARDS = 1  # Number of worker processes, client ids are owned by worker client_id % SHARDS
+SHARD = 0  # Index of this worker
+
 # Store client sessions and message buffers
-sessions = {}  # {client_id: websocket}
-buffers = defaultdict(list)  # {client_id: [messages]}
+sessions = {}  # {client_id: websocket}, clients connected to this worker
+ready = {}  # {client_id: asyncio.Event}, subscribed clients connected to this worker
+peers = {}  # {shard: shards.Peer}, every other worker
+
+# Only for client ids owned by this worker
+buffers = {}  # {client_id: deque}, at most BUFFER_SIZE messages, only present while non-empty
+logs = {}  # {client_id: DurableMessageBuffer}, newer messages than those in buffers when both are used
+locations = {}  # {client_id: shard}, worker each associated client is connected to
+subscribers = {}  # {client_id: shard}, worker each subscribed client is connected to
+space = {}  # {client_id: asyncio.Event}, set once a full buffer has room again
+leased = {}  # {client_id: messages}, set aside for other workers, only present while non-zero
+notified = set()  # Client ids whose subscriber's worker was told and has not fetched since
 
 # Packet structure:
 # MANAGEMENT packet: 3 bytes (type: 1 byte, message: 1 byte, id: client_id)
+#   ASSOCIATE may carry a 4th byte of flags (bit 0: SUBSCRIBE, push messages instead of waiting for GET,
+#   bit 1: FLOWCONTROL, PUSH waits for room instead of failing and its response carries a 4th byte with
+#   the number of messages the receiver can still take, capped at 255)
 # CONTROL packet: 3 bytes (type: 1 byte, message: 1 byte, id: client_id)
+#   GETBATCH carries a 4th byte with the maximum number of messages to return
 # DATA packet: 5 bytes (type: 1 byte, message: 1 byte, id: 1 byte, id2: 1 byte, length: 1 byte) + variable-length payload
+#   BATCHRESPONSE: 4 bytes (type: 1 byte, message: 1 byte, id: 1 byte, count: 1 byte)
+#   followed by count entries of (id2: 1 byte, length: 1 byte) + variable-length payload
+# Any packet may set the high bit of its type and end with a request id byte, its response then does the
+# same with the same id so that clients can match responses to requests. Pushed messages never have one.
+
+SUBSCRIBE = 1 << 0
+FLOWCONTROL = 1 << 1
+REQUEST_ID = 1 << 7
+
+GETRESPONSE_HEADER = struct.Struct("!BBBBB")
+BATCHRESPONSE_HEADER = struct.Struct("!BBBB")
+CREDIT_RESPONSE = struct.Struct("!BBBB")
+
+
+def replies(packet_type, packet_message):
+    # Every 3 byte response only varies by client id, so build them all once
+    return [
+        struct.pack("!BBB", packet_type, packet_message, client_id)
+        for client_id in range(256)
+    ]
+
+
+ASSOCIATIONSUCCESS = replies(0, 1)
+ASSOCIATIONFAILED = replies(0, 2)
+UNKNOWNERROR = replies(0, 3)
+BUFFEREMPTY = replies(1, 1)
+POSITIVEACK = replies(1, 2)
+BUFFERFULL = replies(1, 3)
+
+
+PACKET_NAMES = {(0, 0): "ASSOCIATE", (1, 0): "GET", (1, 4): "GETBATCH", (2, 1): "PUSH"}
+RESPONSE_NAMES = {
+    (0, 1): "ASSOCIATIONSUCCESS",
+    (0, 2): "ASSOCIATIONFAILED",
+    (0, 3): "UNKNOWNERROR",
+    (1, 1): "BUFFEREMPTY",
+    (1, 2): "POSITIVEACK",
+    (1, 3): "BUFFERFULL",
+    (2, 0): "GETRESPONSE",
+    (2, 2): "BATCHRESPONSE",
+}
+
+PEER_OP_NAMES = {
+    shards.PUSH: "PUSH",
+    shards.POP: "POP",
+    shards.POPMANY: "POPMANY",
+    shards.ASSOCIATE: "ASSOCIATE",
+    shards.RELEASE: "RELEASE",
+    shards.NOTIFY: "NOTIFY",
+    shards.WAIT: "WAIT",
+    shards.LEASEPUSH: "LEASEPUSH",
+    shards.PUSHLEASED: "PUSHLEASED",
+    shards.RETURN: "RETURN",
+    shards.POPFRAMES: "POPFRAMES",
+}
+
+packets_total = metrics.Counter(
+    "emessenger_packets_total", "Packets received.", "packet", PACKET_NAMES
+)
+responses_total = metrics.Counter(
+    "emessenger_responses_total", "Responses sent.", "response", RESPONSE_NAMES
+)
+errors_total = metrics.Counter(
+    "emessenger_errors_total", "Connections ended by an exception.", "exception"
+)
+peer_requests_total = metrics.Counter(
+    "emessenger_peer_requests_total", "Requests from other workers.", "op", PEER_OP_NAMES
+)
+pushed_messages_total = metrics.Counter(
+    "emessenger_pushed_messages_total", "Messages pushed to subscribers."
+)
+handler_seconds = metrics.Histogram(
+    "emessenger_handler_seconds",
+    "Time from receiving a packet to having responded to it.",
+    (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 1e-2, 0.1, 1.0),
+)
+buffer_depth = metrics.Histogram(
+    "emessenger_buffer_depth",
+    "Messages buffered for the receiver after each PUSH.",
+    (1, 2, 5, 10, 25, 50, 100, 1_000, 10_000, 100_000, 1_000_000),
+)
+event_loop_lag_seconds = metrics.Histogram(
+    "emessenger_event_loop_lag_seconds",
+    "How late the event loop runs a timer.",
+    (1e-4, 5e-4, 1e-3, 5e-3, 1e-2, 5e-2, 0.1, 0.5, 1.0),
+)
+metrics.Gauge(
+    "emessenger_sessions", "Clients associated with this worker.", lambda: len(sessions)
+)
+metrics.Gauge(
+    "emessenger_buffered_messages",
+    "Messages buffered in memory and on disk for client ids owned by this worker.",
+    lambda: sum(map(len, buffers.values())) + sum(map(len, logs.values())),
+)
+
+
+def tag(response, request_id):
+    # Frames built for a request are bytearrays ending with the spare byte, tagged or trimmed in
+    # place. Shared replies and frames from a peer are bytes without one, only copied to be tagged
+    if isinstance(response, bytearray):
+        if request_id is None:
+            del response[-1]
+        else:
+            response[0] |= REQUEST_ID
+            response[-1] = request_id
+    elif request_id is not None:
+        response = bytearray().join((response, bytes((request_id,))))
+        response[0] |= REQUEST_ID
+
+    return response
+
+
+def associate(client_id, shard, subscribe):
+    if client_id in locations:
+        return False
+
+    locations[client_id] = shard
+    if subscribe:
+        subscribers[client_id] = shard
+
+    return True
+
+
+def release(client_id):
+    del locations[client_id]
+    subscribers.pop(client_id, None)
+    notified.discard(client_id)
+
+    # Nobody will read this buffer for a while, move it to disk
+    buffer = buffers.get(client_id)
+    if buffer is not None and DATA_DIR is not None:
+        del buffers[client_id]
+        open_log(client_id).prepend(buffer)
+
+
+def open_log(client_id):
+    log = logs.get(client_id)
+    if log is None:
+        log = logs[client_id] = DurableMessageBuffer(
+            os.path.join(DATA_DIR, f"{client_id}.log"), DURABLE_BUFFER_SIZE, spare=1
+        )
+
+    return log
+
+
+def open_logs():
+    # Pick up whatever was left on disk by a previous run
+    for name in os.listdir(DATA_DIR):
+        client_id, extension = os.path.splitext(name)
+        if extension == ".log" and client_id.isdigit() and int(client_id) % SHARDS == SHARD:
+            open_log(int(client_id))
+
+
+def remaining(receiver_id):
+    buffer = buffers.get(receiver_id)
+    credits = BUFFER_SIZE - (len(buffer) if buffer is not None else 0)
+
+    if DATA_DIR is not None:
+        log = logs.get(receiver_id)
+        credits = max(credits, 0) + DURABLE_BUFFER_SIZE - (len(log) if log else 0)
+
+    return credits - leased.get(receiver_id, 0)
+
+
+def grant(receiver_id):
+    # Only while there would be room for a lease for every worker, so that near the end of the buffer
+    # every PUSH is checked by the owner
+    if remaining(receiver_id) < LEASE * SHARDS:
+        return 0
+
+    leased[receiver_id] = leased.get(receiver_id, 0) + LEASE
+    return LEASE
+
+
+def give_back(receiver_id, count):
+    left = leased[receiver_id] - count
+    if left:
+        leased[receiver_id] = left
+    else:
+        del leased[receiver_id]
+
+
+async def wait_for_space(receiver_id, timeout):
+    if remaining(receiver_id) > 0:
+        return
+
+    event = space.get(receiver_id)
+    if event is None:
+        event = space[receiver_id] = asyncio.Event()
+
+    try:
+        await asyncio.wait_for(event.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+
+
+def wake(client_id):
+    event = space.pop(client_id, None)
+    if event is not None:
+        event.set()
+
+
+def notify(client_id):
+    if client_id in ready:
+        ready[client_id].set()
+
+
+def push_message(receiver_id, message, lease=False):
+    # Messages for online receivers stay in memory until something has been spilled to disk,
+    # from then on they go to disk as well so that the log only ever holds the newest messages.
+    # Room set aside for other workers is only taken by a message pushed under a lease
+    if lease:
+        give_back(receiver_id, 1)
+    elif receiver_id in leased and remaining(receiver_id) <= 0:
+        return False
+
+    buffer = None
+    if DATA_DIR is None or (receiver_id in locations and not logs.get(receiver_id)):
+        buffer = buffers.get(receiver_id)
+        if buffer is None:
+            buffer = buffers[receiver_id] = deque()
+        elif len(buffer) >= BUFFER_SIZE:
+            buffer = None
+
+    if buffer is None and DATA_DIR is not None:
+        buffer = open_log(receiver_id)
+        if buffer.full():
+            buffer = None
+
+    if buffer is None:
+        return False
+
+    # In memory this is the only copy a message ever sees: the PUSH is rewritten in place into the
+    # GETRESPONSE that will eventually be sent, both headers are 5 bytes long
+    frame = bytearray().join((message, b"\0"))
+    GETRESPONSE_HEADER.pack_into(frame, 0, 2, 0, receiver_id, message[2], message[4])
+    buffer.append(frame)
+    buffer_depth.observe(len(buffer))
+
+    shard = subscribers.get(receiver_id)
+    if shard == SHARD:
+        notify(receiver_id)
+    elif shard is not None and receiver_id not in notified:
+        notified.add(receiver_id)
+        peers[shard].notify(receiver_id)
+
+    return True
+
+
+def pop_message(client_id):
+    buffer = buffers.get(client_id)
+    if buffer is None:
+        buffer = logs.get(client_id)
+        if not buffer:
+            return None
+
+        frame = buffer.popleft()
+    else:
+        frame = buffer.popleft()
+        if not buffer:
+            del buffers[client_id]
+
+    wake(client_id)
+    return frame  # GETRESPONSE
+
+
+def pop_messages(client_id, count):
+    buffer = buffers.get(client_id)
+    log = logs.get(client_id)
+    if buffer is None and not log:
+        return None
+
+    frames = []
+    if buffer is not None:
+        popleft = buffer.popleft
+        frames = [popleft() for _ in range(min(count, len(buffer)))]
+        if not buffer:
+            del buffers[client_id]
+    if log and len(frames) < count:
+        frames += log.pop_many(count - len(frames))
+
+    wake(client_id)
+
+    # Each entry is the tail of a GETRESPONSE without its spare byte: (id2, length) + payload
+    response = bytearray(
+        BATCHRESPONSE_HEADER.size + sum(len(frame) - 4 for frame in frames) + 1
+    )
+    BATCHRESPONSE_HEADER.pack_into(response, 0, 2, 2, client_id, len(frames))
+
+    offset = BATCHRESPONSE_HEADER.size
+    for frame in frames:
+        end = offset + len(frame) - 4
+        response[offset:end] = memoryview(frame)[3:-1]
+        offset = end
+
+    return response  # BATCHRESPONSE
+
+
+def handle_peer_request(op, client_id, payload):
+    peer_requests_total.inc(op)
+    if op == shards.PUSH:
+        accepted = push_message(client_id, payload)
+        return bytes([accepted, max(0, min(remaining(client_id), 255))])
+    elif op == shards.LEASEPUSH:
+        accepted = push_message(client_id, payload)
+        lease = grant(client_id) if accepted else 0
+        return bytes([accepted, max(0, min(remaining(client_id), 255)), lease])
+    elif op == shards.PUSHLEASED:
+        push_message(client_id, payload, lease=True)  # There is room, it was set aside
+        return None
+    elif op == shards.RETURN:
+        give_back(client_id, shards.COUNT.unpack(payload)[0])
+        return None
+    elif op == shards.POP:
+        # Frames reach the peer as bytes, so without the spare byte
+        return tag(pop_message(client_id) or b"", None)
+    elif op == shards.POPMANY:
+        return tag(pop_messages(client_id, payload[0]) or b"", None)
+    elif op == shards.POPFRAMES:
+        notified.discard(client_id)  # Anything pushed after this has to tell it again
+        frames = []
+        for _ in range(payload[0]):
+            frame = pop_message(client_id)
+            if frame is None:
+                break
+
+            frames += (shards.FRAME.pack(len(frame) - 1), memoryview(frame)[:-1])
+
+        return b"".join(frames)
+    elif op == shards.ASSOCIATE:
+        return b"\x01" if associate(client_id, payload[0], payload[1]) else b"\x00"
+    elif op == shards.RELEASE:
+        release(client_id)
+        return b""
+    elif op == shards.NOTIFY:
+        notify(client_id)
+        return None
+    elif op == shards.WAIT:
+        return wait_for_space(client_id, shards.TIMEOUT.unpack(payload)[0] / 1000)
+
+
+async def route_push(receiver_id, message, flow_control):
+    # Returns whether the message was buffered and how many more the receiver can take
+    shard = receiver_id % SHARDS
+    deadline = None
+    while True:
+        if shard == SHARD:
+            accepted = push_message(receiver_id, message)
+            credits = remaining(receiver_id) if flow_control else 0
+        elif flow_control:
+            # Credits have to come from the owner
+            accepted, credits = await peers[shard].push(receiver_id, message)
+        elif peers[shard].push_leased(receiver_id, message):
+            return True, 0
+        else:
+            accepted, credits = await peers[shard].push(receiver_id, message, lease=True)
+
+        if accepted or not flow_control:
+            return accepted, credits
+
+        # Not reading from this sender while it waits lets websockets and TCP push back on it,
+        # instead of it retrying in a loop
+        loop = asyncio.get_running_loop()
+        if deadline is None:
+            deadline = loop.time() + FLOW_CONTROL_TIMEOUT
+
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+            return False, 0
+
+        if shard == SHARD:
+            await wait_for_space(receiver_id, timeout)
+        else:
+            await peers[shard].wait_for_space(receiver_id, timeout)
+
+
+async def push_messages(websocket, client_id, event):
+    # Deliver buffered messages to a subscribed client as soon as they arrive
+    shard = client_id % SHARDS
+    while True:
+        await event.wait()
+        event.clear()
+
+        if shard == SHARD:
+            while True:
+                frame = pop_message(client_id)
+                if frame is None:
+                    break
+
+                await websocket.send(tag(frame, None))
+                pushed_messages_total.inc()
+        else:
+            # A batch per round trip, a short one means the owner had no more
+            while True:
+                frames = await peers[shard].pop_frames(client_id, PUSH_BATCH)
+                for frame in frames:
+                    await websocket.send(frame)
+                    pushed_messages_total.inc()
+
+                if len(frames) < PUSH_BATCH:
+                    break
 
 
 async def handle_connection(websocket):
     # print("New client connected")
     client_id = None
+    associated_id = None
+    subscription = None
+    flow_control = False
+    request_id = None
+
+    async def respond(response):
+        responses_total.inc((response[0], response[1]))
+        await websocket.send(tag(response, request_id))
+        handler_seconds.observe(perf_counter() - started_at)
+
     try:
         async for message in websocket:
+            started_at = perf_counter()
             # print(buffers)
             # Parse the packet type and message
             packet_type = message[0]  # First byte is the packet type
             packet_message = message[1]  # Second byte is the message type
 
+            request_id = None
+            if packet_type & REQUEST_ID:
+                packet_type &= ~REQUEST_ID
+                request_id = message[-1]
+                message = memoryview(message)[:-1]  # Everything else stays where it was
+
+            packets_total.inc((packet_type, packet_message))
+
             if packet_type == 0:  # MANAGEMENT packet
                 if packet_message == 0:  # ASSOCIATE
                     # print("Received raw message 1:", message)
                     client_id = message[2]  # Extract id (1 byte)
-                    if client_id in sessions:
-                        response = struct.pack("!BBB", 0, 3, client_id)  # UNKNOWNERROR
+                    subscribe = len(message) > 3 and message[3] & SUBSCRIBE
+
+                    shard = client_id % SHARDS
+                    if associated_id is not None:
+                        accepted = False
+                    elif shard == SHARD:
+                        accepted = associate(client_id, SHARD, subscribe)
+                    else:
+                        accepted = await peers[shard].associate(
+                            client_id, SHARD, subscribe
+                        )
+
+                    if not accepted:
+                        response = UNKNOWNERROR[client_id]
                         # print("Raw response 1:", response)
-                        await websocket.send(response)
+                        await respond(response)
                         # await websocket.close()  # Forcefully close the new connection
                     else:
                         sessions[client_id] = websocket
-                        response = struct.pack(
-                            "!BBB", 0, 1, client_id
-                        )  # ASSOCIATIONSUCCESS
+                        associated_id = client_id
+                        flow_control = len(message) > 3 and message[3] & FLOWCONTROL
+                        response = ASSOCIATIONSUCCESS[client_id]
                         print("ASSOCIATION SUCCESS")
                         # print("Raw response 2:", response)
-                        await websocket.send(response)
+                        await respond(response)
+
+                        if subscribe:
+                            event = ready[client_id] = asyncio.Event()
+                            event.set()  # Flush whatever was buffered while offline
+
+                            subscription = asyncio.create_task(
+                                push_messages(websocket, client_id, event)
+                            )
                 else:
                     # print("Received raw message 2:", message)
                     client_id = message[2]  # Extract id (1 byte)
-                    response = struct.pack("!BBB", 0, 3, client_id)  # UNKNOWNERROR
+                    response = UNKNOWNERROR[client_id]
                     # print("Raw response 3:", response)
-                    await websocket.send(response)
+                    await respond(response)
 
             elif packet_type == 1:  # CONTROL packet
                 if packet_message == 0:  # GET
                     # print("Received raw message 3:", message)
                     client_id = message[2]  # Extract id (1 byte)
+                    shard = client_id % SHARDS
                     if client_id not in sessions:
-                        response = struct.pack(
-                            "!BBB", 0, 2, client_id
-                        )  # ASSOCIATIONFAILED
+                        response = ASSOCIATIONFAILED[client_id]
                         # print("Raw response 4:", response)
-                    elif not buffers[client_id]:
-                        response = struct.pack("!BBB", 1, 1, client_id)  # BUFFEREMPTY
+                    else:
+                        if shard == SHARD:
+                            response = pop_message(client_id)  # GETRESPONSE
+                        else:
+                            response = await peers[shard].pop(client_id)
+
+                        if response is None:
+                            response = BUFFEREMPTY[client_id]
                         # print("Raw response 5:", response)
+                    await respond(response)
+                elif packet_message == 4:  # GETBATCH
+                    client_id = message[2]  # Extract id (1 byte)
+                    shard = client_id % SHARDS
+                    if client_id not in sessions:
+                        response = ASSOCIATIONFAILED[client_id]
+                    elif len(message) != 4 or message[3] == 0:
+                        response = UNKNOWNERROR[client_id]
                     else:
-                        message_payload = buffers[client_id].pop(0)
-                        sender_id = message_payload[0]
-                        message_payload = message_payload[3:]
-                        response = (
-                            struct.pack(
-                                "!BBBBB",
-                                2,
-                                0,
-                                client_id,
-                                sender_id,
-                                len(message_payload),
-                            )
-                            + message_payload
-                        )  # GETRESPONSE
-                        # print("Raw response 6:", response)
-                    await websocket.send(response)
+                        if shard == SHARD:
+                            response = pop_messages(client_id, message[3])  # BATCHRESPONSE
+                        else:
+                            response = await peers[shard].pop_many(client_id, message[3])
+
+                        if response is None:
+                            response = BUFFEREMPTY[client_id]
+                    await respond(response)
                 else:
                     # print("Received raw message 4:", message)
                     client_id = message[2]  # Extract id (1 byte)
-                    response = struct.pack("!BBB", 0, 3, client_id)  # UNKNOWNERROR
+                    response = UNKNOWNERROR[client_id]
                     # print("Raw response 7:", response)
-                    await websocket.send(response)
+                    await respond(response)
 
             elif packet_type == 2:  # DATA packet
                 if packet_message == 1:  # PUSH
                     client_id = message[2]  # Extract id (1 byte)
                     # print("Received raw message 5:", message)
                     if client_id not in sessions:
-                        response = struct.pack(
-                            "!BBB", 0, 2, client_id
-                        )  # ASSOCIATIONFAILED
+                        response = ASSOCIATIONFAILED[client_id]
                     else:
                         receiver_id = message[3]  # Extract receiver_id (1 bytes)
                         length = message[4]
-                        payload = message[5:]  # Extract payload (variable length)
                         if length < 255:
-                            if length == len(payload):
-                                if len(buffers[receiver_id]) < 100:  # Buffer size limit
-                                    buffers[receiver_id].append(message[2:])
-                                    response = struct.pack(
-                                        "!BBB", 1, 2, client_id
-                                    )  # POSITIVEACK
+                            # Payload is never sliced out, only its length is checked
+                            if length == len(message) - 5:
+                                accepted, credits = await route_push(
+                                    receiver_id, message, flow_control
+                                )
+
+                                if flow_control:
+                                    response = CREDIT_RESPONSE.pack(
+                                        1, 2 if accepted else 3, client_id, min(credits, 255)
+                                    )  # POSITIVEACK / BUFFERFULL
+                                elif accepted:
+                                    response = POSITIVEACK[client_id]
                                 else:
-                                    response = struct.pack(
-                                        "!BBB", 1, 3, client_id
-                                    )  # BUFFERFULL
+                                    response = BUFFERFULL[client_id]
                             else:
-                                response = struct.pack(
-                                    "!BBB", 0, 3, client_id
-                                )  # UNKNOWNERROR
+                                response = UNKNOWNERROR[client_id]
                         else:
-                            response = struct.pack(
-                                "!BBB", 0, 3, client_id
-                            )  # UNKNOWNERROR
+                            response = UNKNOWNERROR[client_id]
                         # print("Raw response 8:", response)
-                        await websocket.send(response)
+                        await respond(response)
                 else:
                     # print("Received raw message 6:", message)
                     client_id = message[2]  # Extract id (1 byte)
-                    response = struct.pack("!BBB", 0, 3, client_id)  # UNKNOWNERROR
+                    response = UNKNOWNERROR[client_id]
                     # print("Raw response 9:", response)
-                    await websocket.send(response)
+                    await respond(response)
 
-    except Exception:
+    except Exception as e:
         # print(f"Error: {e}")
-        pass
+        errors_total.inc(type(e).__name__)
     finally:
-        if client_id in sessions:
-            del sessions[client_id]
+        if subscription is not None:
+            subscription.cancel()
+            del ready[associated_id]
+        if associated_id is not None:
+            del sessions[associated_id]
+
+            shard = associated_id % SHARDS
+            if shard == SHARD:
+                release(associated_id)
+            else:
+                await peers[shard].release(associated_id)
         print("Client disconnected")
 
 
-async def start_server():
-    async with websockets.serve(handle_connection, "", 12345):
-        # print("WebSocket server started on ws://localhost:12345")
+async def start_server(
+    port=12345, socket_dir=None, metrics_port=None, metrics_host="127.0.0.1"
+):
+    if DATA_DIR is not None:
+        open_logs()
+
+    lag_sampler = None
+    if metrics_port is not None:
+        # One port per worker, each reports on the client ids it owns
+        await metrics.serve(metrics_port + SHARD, {"shard": SHARD}, metrics_host)
+        lag_sampler = asyncio.create_task(
+            metrics.sample_event_loop_lag(event_loop_lag_seconds)
+        )
+
+    if SHARDS > 1:
+        await shards.serve(shards.socket_path(socket_dir, SHARD), handle_peer_request)
+        for shard in range(SHARDS):
+            if shard != SHARD:
+                peers[shard] = await shards.Peer.connect(
+                    shards.socket_path(socket_dir, shard)
+                )
+
+    # Every worker listens on the same port and the kernel spreads connections between them
+    async with websockets.serve(handle_connection, "", port, reuse_port=SHARDS > 1):
+        # print(f"WebSocket server started on ws://localhost:{port}")
         await asyncio.Future()  # Run forever
 
+    if lag_sampler is not None:
+        lag_sampler.cancel()
+
+
+def start_worker(shard, args, socket_dir):
+    global BUFFER_SIZE, DATA_DIR, DURABLE_BUFFER_SIZE, SHARDS, SHARD
+
+    BUFFER_SIZE = args.buffer_size
+    DATA_DIR = args.data_dir
+    DURABLE_BUFFER_SIZE = args.durable_buffer_size
+    SHARDS = args.workers
+    SHARD = shard
+
+    asyncio.run(start_server(args.port, socket_dir, args.metrics_port, args.metrics_host))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=12345)
+    parser.add_argument("--buffer-size", type=int, default=BUFFER_SIZE)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--data-dir")
+    parser.add_argument("--durable-buffer-size", type=int, default=DURABLE_BUFFER_SIZE)
+    parser.add_argument("--metrics-port", type=int, help="serve /metrics over HTTP")
+    parser.add_argument("--metrics-host", default="127.0.0.1", help="address to serve it on")
+    args = parser.parse_args()
+
+    if args.data_dir is not None:
+        os.makedirs(args.data_dir, exist_ok=True)
+
+    if args.workers == 1:
+        BUFFER_SIZE = args.buffer_size
+        DATA_DIR = args.data_dir
+        DURABLE_BUFFER_SIZE = args.durable_buffer_size
+
+        # Run the server
+        asyncio.run(
+            start_server(
+                args.port, metrics_port=args.metrics_port, metrics_host=args.metrics_host
+            )
+        )
+    else:
+        with tempfile.TemporaryDirectory() as socket_dir:
+            workers = [
+                multiprocessing.Process(
+                    target=start_worker, args=(shard, args, socket_dir)
+                )
+                for shard in range(args.workers)
+            ]
 
-# Run the server
-asyncio.run(start_server())
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
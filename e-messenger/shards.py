@@ -0,0 +1,198 @@
+import asyncio
+import os
+import struct
+
+# Worker to worker requests over Unix sockets, used when the server is sharded across processes.
+# Every client id is owned by worker client_id % workers, which holds its buffer and association.
+# Request: (length: 4 bytes, request_id: 4 bytes, op: 1 byte, id: 1 byte) + payload
+# Response: (length: 4 bytes, request_id: 4 bytes) + payload, not sent for NOTIFY, PUSHLEASED, RETURN
+# Whatever is written in one iteration of the loop goes out in one system call.
+#
+# A LEASEPUSH is answered with a lease, a number of messages the owner has set aside for the receiver.
+# Until it runs out the peer sends the receiver's messages as PUSHLEASED and answers the sender right
+# away, with no round trip. What is left of a lease goes back with RETURN after LEASE_SECONDS, behind
+# every PUSHLEASED on the same socket, so the owner never sees a message after its lease has ended.
+
+REQUEST = struct.Struct("!IIBB")
+RESPONSE = struct.Struct("!II")
+TIMEOUT = struct.Struct("!I")  # Milliseconds
+COUNT = struct.Struct("!I")
+FRAME = struct.Struct("!H")  # Length of each frame in a POPFRAMES response
+LEASE_SECONDS = 1.0
+
+PUSH, POP, POPMANY, ASSOCIATE, RELEASE, NOTIFY, WAIT = range(7)
+LEASEPUSH, PUSHLEASED, RETURN, POPFRAMES = range(7, 11)
+
+
+def socket_path(directory, shard):
+    return os.path.join(directory, f"shard-{shard}.sock")
+
+
+class Peer:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+        self.futures = {}  # {request_id: asyncio.Future}
+        self.next_request_id = 1
+        self.outgoing = []  # Written together once the loop gets to it
+
+        self.leases = {}  # {receiver_id: messages}, that can still be pushed without asking
+        self.returning = None  # Timer that gives back what is left of the leases
+
+        self.listener = asyncio.create_task(self.listen())
+
+    @classmethod
+    async def connect(cls, path):
+        # Workers start at the same time, so wait for the other side to come up
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(path)
+            except (FileNotFoundError, ConnectionRefusedError):
+                await asyncio.sleep(0.05)
+            else:
+                return cls(reader, writer)
+
+    async def listen(self):
+        while True:
+            length, request_id = RESPONSE.unpack(
+                await self.reader.readexactly(RESPONSE.size)
+            )
+            payload = await self.reader.readexactly(length) if length else b""
+            self.futures.pop(request_id).set_result(payload)
+
+    def send(self, request_id, op, client_id, payload=b""):
+        outgoing = self.outgoing
+        if not outgoing:
+            asyncio.get_running_loop().call_soon(self.flush)
+
+        outgoing.append(REQUEST.pack(len(payload), request_id, op, client_id))
+        if payload:
+            outgoing.append(payload)
+
+    def flush(self):
+        self.writer.writelines(self.outgoing)
+        self.outgoing.clear()
+
+    async def call(self, op, client_id, payload=b""):
+        request_id = self.next_request_id
+        self.next_request_id = request_id % 0xFFFFFFFF + 1  # 0 is reserved for NOTIFY
+
+        future = self.futures[request_id] = asyncio.get_running_loop().create_future()
+        self.send(request_id, op, client_id, payload)
+        await self.writer.drain()
+
+        return await future
+
+    async def push(self, receiver_id, message, lease=False):
+        if not lease:
+            accepted, credits = await self.call(PUSH, receiver_id, message)
+            return bool(accepted), credits
+
+        accepted, credits, granted = await self.call(LEASEPUSH, receiver_id, message)
+        if granted:
+            self.leases[receiver_id] = self.leases.get(receiver_id, 0) + granted
+            if self.returning is None:
+                self.returning = asyncio.get_running_loop().call_later(
+                    LEASE_SECONDS, self.return_leases
+                )
+
+        return bool(accepted), credits
+
+    def push_leased(self, receiver_id, message):
+        # Whether the message fit in a lease, it is as good as buffered then
+        leases = self.leases
+        if not leases.get(receiver_id):
+            return False
+
+        leases[receiver_id] -= 1
+        self.send(0, PUSHLEASED, receiver_id, message)
+        return True
+
+    def return_leases(self):
+        self.returning = None
+        for receiver_id, count in self.leases.items():
+            if count:
+                self.send(0, RETURN, receiver_id, COUNT.pack(count))
+
+        self.leases.clear()
+
+    async def pop(self, client_id):
+        return await self.call(POP, client_id) or None
+
+    async def pop_many(self, client_id, count):
+        return await self.call(POPMANY, client_id, bytes([count])) or None
+
+    async def pop_frames(self, client_id, count):
+        # Up to count GETRESPONSE frames, as the owner would have popped them one at a time
+        response = await self.call(POPFRAMES, client_id, bytes([count]))
+
+        frames = []
+        offset = 0
+        while offset < len(response):
+            end = offset + FRAME.size + FRAME.unpack_from(response, offset)[0]
+            frames.append(response[offset + FRAME.size : end])
+            offset = end
+
+        return frames
+
+    async def associate(self, client_id, shard, subscribe):
+        response = await self.call(ASSOCIATE, client_id, bytes([shard, subscribe]))
+        return response == b"\x01"
+
+    async def release(self, client_id):
+        await self.call(RELEASE, client_id)
+
+    def notify(self, client_id):
+        self.send(0, NOTIFY, client_id)
+
+    async def wait_for_space(self, client_id, timeout):
+        await self.call(WAIT, client_id, TIMEOUT.pack(int(timeout * 1000)))
+
+
+async def serve(path, handle_request):
+    # handle_request(op, client_id, payload) returns the response payload, None for no response, or a
+    # coroutine for requests that have to wait, whose response is sent once it finishes
+    async def respond_later(respond, request_id, response):
+        respond(request_id, await response or b"")
+
+    waiting = set()  # Keeps the tasks alive until they respond
+
+    async def handle_peer(reader, writer):
+        outgoing = []  # Written together once the loop gets to it
+
+        def flush():
+            writer.writelines(outgoing)
+            outgoing.clear()
+
+        def respond(request_id, response):
+            if not outgoing:
+                asyncio.get_running_loop().call_soon(flush)
+
+            outgoing.append(RESPONSE.pack(len(response), request_id))
+            outgoing.append(response)
+
+        try:
+            while True:
+                length, request_id, op, client_id = REQUEST.unpack(
+                    await reader.readexactly(REQUEST.size)
+                )
+                payload = await reader.readexactly(length) if length else b""
+
+                response = handle_request(op, client_id, payload)
+                if asyncio.iscoroutine(response):
+                    task = asyncio.create_task(respond_later(respond, request_id, response))
+                    waiting.add(task)
+                    task.add_done_callback(waiting.discard)
+                elif response is not None:
+                    respond(request_id, response)
+                    await writer.drain()
+        except asyncio.IncompleteReadError:
+            pass
+        finally:
+            writer.close()
+
+    if os.path.exists(path):
+        os.unlink(path)
+
+    return await asyncio.start_unix_server(handle_peer, path)
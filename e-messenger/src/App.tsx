@@ -15,6 +15,10 @@ import { toast } from "sonner";
 import { Spinner } from "./components/ui/spinner";
 
 const POLL_INTERVAL = 1000;
+const MAX_REQUESTS = 256; // Request ids are a single byte
+const BATCH_SIZE = 64; // Maximum number of messages fetched per GETBATCH
+const SUBSCRIBE = true; // Ask the server to push messages instead of polling for them
+const FLOW_CONTROL = true; // Ask the server to hold PUSHes to a full buffer for a while instead of failing them
 const DEFAULT_SETTINGS: Settings = { clientID: 172, socketURL: "ws://localhost:12345" };
 
 interface Request {
@@ -34,10 +38,9 @@ function App() {
   const webSocketRef = useRef(webSocket);
   useEffect(() => void (webSocketRef.current = webSocket), [webSocket]);
 
-  const [requests, setRequests] = useState<Request[]>([]);
-
-  const requestsRef = useRef(requests);
-  useEffect(() => void (requestsRef.current = requests), [requests]);
+  // Responses are matched by request id, kept in refs so that responses never race a render
+  const requestsRef = useRef(new Map<number, Request>());
+  const nextRequestIDRef = useRef(0);
 
   const [intervalID, setIntervalID] = useState<ReturnType<typeof setInterval> | null>(null);
 
@@ -95,48 +98,62 @@ function App() {
       throw new Error("Websocket is not connected yet");
 
     return new Promise((resolve, reject) => {
-      setRequests((requests) => [...requests, { resolve, reject }]);
-      webSocketRef.current!.send(packet.encode());
+      if (requestsRef.current.size >= MAX_REQUESTS) return reject(new Error("Too many requests in flight"));
+
+      let requestID = nextRequestIDRef.current;
+      while (requestsRef.current.has(requestID)) requestID = (requestID + 1) % MAX_REQUESTS;
+      nextRequestIDRef.current = (requestID + 1) % MAX_REQUESTS;
+
+      requestsRef.current.set(requestID, { resolve, reject });
+      webSocketRef.current!.send(packet.encodeWithRequestID(requestID));
     });
   };
 
   const reset = () => {
     setIsAssociated(false);
 
-    for (const request of requestsRef.current) request.reject(new Error("Websocket is reset"));
-    setRequests([]);
+    for (const request of requestsRef.current.values()) request.reject(new Error("Websocket is reset"));
+    requestsRef.current.clear();
 
     if (intervalIDRef.current !== null) clearInterval(intervalIDRef.current);
     setIntervalID(null);
   };
 
+  const onReceiveMessage = (response: DataPacket) => {
+    const rawMessages = localStorage.getItem(chatKey(response.id2));
+    const oldMessages: Message[] = rawMessages !== null ? JSON.parse(rawMessages) : [];
+
+    const messages = [...oldMessages, { isSelf: false, content: response.payload }];
+
+    if (response.id2 === receiverRef.current?.id) setMessages(messages);
+    localStorage.setItem(chatKey(response.id2), JSON.stringify(messages));
+
+    if (users.find(({ id }) => id === response.id2) === undefined) {
+      const user = {
+        id: response.id2,
+        nickname: `User #${response.id2.toString().padStart(3, "0")}`,
+        avatarURL: `https://cdn2.thecatapi.com/images/${100 + response.id2}.jpg`,
+      };
+
+      onNewChat(user);
+    }
+  };
+
   const pollForMessages = async (intervalID: ReturnType<typeof setInterval>) => {
     for (;;) {
       try {
         if (webSocketRef.current === null || webSocketRef.current.readyState !== WebSocket.OPEN) break;
 
-        const response = await sendPacket(ControlPacket.get(clientIDRef.current));
+        const response = await sendPacket(ControlPacket.getBatch(clientIDRef.current, BATCH_SIZE));
         if (response.isControl() && response.isBufferEmpty()) break;
 
-        if (response.isData() && response.isGetResponse()) {
-          const rawMessages = localStorage.getItem(chatKey(response.id2));
-          const oldMessages: Message[] = rawMessages !== null ? JSON.parse(rawMessages) : [];
-
-          const messages = [...oldMessages, { isSelf: false, content: response.payload }];
-
-          if (response.id2 === receiverRef.current?.id) setMessages(messages);
-          localStorage.setItem(chatKey(response.id2), JSON.stringify(messages));
-
-          if (users.find(({ id }) => id === response.id2) === undefined) {
-            const user = {
-              id: response.id2,
-              nickname: `User #${response.id2.toString().padStart(3, "0")}`,
-              avatarURL: `https://cdn2.thecatapi.com/images/${100 + response.id2}.jpg`,
-            };
-
-            onNewChat(user);
-          }
+        if (response.isBatch()) {
+          for (const message of response.messages) onReceiveMessage(message);
+          continue;
+        }
 
+        if (response.isData() && response.isGetResponse()) {
+          onReceiveMessage(response);
           continue;
         }
 
@@ -159,7 +176,10 @@ function App() {
 
   const associate = async () => {
     try {
-      const response = await sendPacket(ManagementPacket.associate(clientIDRef.current));
+      const response = await sendPacket(ManagementPacket.associate(clientIDRef.current, {
+        subscribe: SUBSCRIBE,
+        flowControl: FLOW_CONTROL,
+      }));
       if (response.isManangement() && response.isUnknownError()) {
         toast.error("Association failed!");
       } else if (response.isManangement() && response.isAssociationSuccess()) {
@@ -167,6 +187,7 @@ function App() {
         toast.info("Associated!");
 
         if (intervalIDRef.current !== null) clearInterval(intervalIDRef.current);
+        if (SUBSCRIBE) return;
 
         const intervalID = setInterval(async () => await pollForMessages(intervalID), POLL_INTERVAL);
         setIntervalID(intervalID);
@@ -196,17 +217,19 @@ function App() {
 
     webSocket.addEventListener("message", async (event: MessageEvent<ArrayBuffer>) => {
       const packet = Packet.decode(event.data);
+      if (packet === null) return console.error("Failed to decode packet");
 
-      if (requestsRef.current.length === 0) return; // Probably from previous websocket?
-      const [request, ...requests] = requestsRef.current;
-
-      if (packet !== null) {
-        request.resolve(packet);
-      } else {
-        request.reject(new Error("Failed to decode packet"));
+      // Pushed messages are the only packets without a request id
+      if (packet.requestID === null) {
+        if (packet.isData() && packet.isGetResponse()) onReceiveMessage(packet);
+        return;
       }
 
-      setRequests(requests);
+      const request = requestsRef.current.get(packet.requestID);
+      if (request === undefined) return; // Probably from previous websocket?
+
+      requestsRef.current.delete(packet.requestID);
+      request.resolve(packet);
     });
 
     webSocket.addEventListener("open", async () => {
@@ -11,19 +11,38 @@ const enum ManagmentMessageType {
   UnknownError = 3,
 }
 
+const enum AssociateFlags {
+  None = 0,
+  Subscribe = 1 << 0,
+  FlowControl = 1 << 1,
+}
+
+export interface AssociateOptions {
+  subscribe?: boolean;
+  flowControl?: boolean;
+}
+
 const enum ControlMessageType {
   Get = 0,
   BufferEmpty = 1,
   PositiveAck = 2,
   BufferFull = 3,
+  GetBatch = 4,
 }
 
 const enum DataMessageType {
   GetResponse = 0,
   Push = 1,
+  BatchResponse = 2,
 }
 
+// Set on the packet type when the packet ends with a request id, responses echo it back
+const REQUEST_ID_FLAG = 1 << 7;
+
 export abstract class Packet {
+  // Only set on responses to requests sent with one, pushed messages never have one
+  public requestID: number | null = null;
+
   public constructor(protected type: PacketType) {}
 
   public isManangement(): this is ManagementPacket {
@@ -35,18 +54,33 @@ export abstract class Packet {
   }
 
   public isData(): this is DataPacket {
-    return this.type === PacketType.Data;
+    return this instanceof DataPacket;
+  }
+
+  public isBatch(): this is BatchPacket {
+    return this instanceof BatchPacket;
   }
 
   public static decode(buffer: ArrayBuffer): Packet | null {
-    const type = new Uint8Array(buffer, 0, 1);
+    const [type] = new Uint8Array(buffer, 0, 1);
+    if (!(type & REQUEST_ID_FLAG)) return Packet.decodeUntagged(type, buffer);
 
-    switch (type[0]) {
+    const requestID = new Uint8Array(buffer, buffer.byteLength - 1, 1)[0];
+
+    const packet = Packet.decodeUntagged(type & ~REQUEST_ID_FLAG, buffer.slice(0, -1));
+    if (packet !== null) packet.requestID = requestID;
+
+    return packet;
+  }
+
+  private static decodeUntagged(type: number, buffer: ArrayBuffer): Packet | null {
+    switch (type) {
       case PacketType.Management:
         return ManagementPacket.decode(buffer);
       case PacketType.Control:
         return ControlPacket.decode(buffer);
       case PacketType.Data:
+        if (new Uint8Array(buffer, 1, 1)[0] === DataMessageType.BatchResponse) return BatchPacket.decode(buffer);
         return DataPacket.decode(buffer);
     }
 
@@ -54,10 +88,23 @@ export abstract class Packet {
   }
 
   public abstract encode(): ArrayBuffer;
+
+  public encodeWithRequestID(requestID: number) {
+    const packet = new Uint8Array(this.encode());
+
+    const buffer = new ArrayBuffer(packet.byteLength + 1);
+    const bytes = new Uint8Array(buffer);
+
+    bytes.set(packet);
+    bytes[0] |= REQUEST_ID_FLAG;
+    bytes[packet.byteLength] = requestID;
+
+    return buffer;
+  }
 }
 
 export class ManagementPacket extends Packet {
-  public constructor(private message: ManagmentMessageType, public id: number) {
+  public constructor(private message: ManagmentMessageType, public id: number, private flags = AssociateFlags.None) {
     super(PacketType.Management);
   }
 
@@ -74,7 +121,8 @@ export class ManagementPacket extends Packet {
   }
 
   public encode() {
-    const buffer = new ArrayBuffer(3);
+    // Flags are only sent when set so that old servers still see a 3 byte ASSOCIATE
+    const buffer = new ArrayBuffer(this.flags === AssociateFlags.None ? 3 : 4);
 
     const type = new Uint8Array(buffer, 0, 1);
     const message = new Uint8Array(buffer, 1, 1);
@@ -84,11 +132,18 @@ export class ManagementPacket extends Packet {
     message[0] = this.message;
     id[0] = this.id;
 
+    if (this.flags !== AssociateFlags.None) new Uint8Array(buffer, 3, 1)[0] = this.flags;
+
     return buffer;
   }
 
-  public static associate(clientID: number) {
-    return new ManagementPacket(ManagmentMessageType.Associate, clientID);
+  public static associate(clientID: number, { subscribe = false, flowControl = false }: AssociateOptions = {}) {
+    return new ManagementPacket(
+      ManagmentMessageType.Associate,
+      clientID,
+      (subscribe ? AssociateFlags.Subscribe : AssociateFlags.None) |
+        (flowControl ? AssociateFlags.FlowControl : AssociateFlags.None),
+    );
   }
 
   public static decode(buffer: ArrayBuffer) {
@@ -100,7 +155,13 @@ export class ManagementPacket extends Packet {
 }
 
 export class ControlPacket extends Packet {
-  public constructor(private message: ControlMessageType, public id: number) {
+  public constructor(
+    private message: ControlMessageType,
+    public id: number,
+    private count = 0,
+    // Messages the receiver can still take, only sent after associating with flow control
+    public credits: number | null = null,
+  ) {
     super(PacketType.Control);
   }
 
@@ -117,7 +178,8 @@ export class ControlPacket extends Packet {
   }
 
   public encode() {
-    const buffer = new ArrayBuffer(3);
+    const isBatch = this.message === ControlMessageType.GetBatch;
+    const buffer = new ArrayBuffer(isBatch ? 4 : 3);
 
     const type = new Uint8Array(buffer, 0, 1);
     const message = new Uint8Array(buffer, 1, 1);
@@ -127,6 +189,8 @@ export class ControlPacket extends Packet {
     message[0] = this.message;
     id[0] = this.id;
 
+    if (isBatch) new Uint8Array(buffer, 3, 1)[0] = this.count;
+
     return buffer;
   }
 
@@ -134,11 +198,16 @@ export class ControlPacket extends Packet {
     return new ControlPacket(ControlMessageType.Get, clientID);
   }
 
+  public static getBatch(clientID: number, count: number) {
+    return new ControlPacket(ControlMessageType.GetBatch, clientID, count);
+  }
+
   public static decode(buffer: ArrayBuffer) {
     const message = new Uint8Array(buffer, 1, 1);
     const id = new Uint8Array(buffer, 2, 1);
+    const credits = buffer.byteLength > 3 ? new Uint8Array(buffer, 3, 1)[0] : null;
 
-    return new ControlPacket(message[0], id[0]);
+    return new ControlPacket(message[0], id[0], 0, credits);
   }
 }
 
@@ -190,3 +259,45 @@ export class DataPacket extends Packet {
     return new DataPacket(message[0], id[0], id2[0], DECODER.decode(payload));
   }
 }
+
+export class BatchPacket extends Packet {
+  public constructor(public id: number, public messages: DataPacket[]) {
+    super(PacketType.Data);
+  }
+
+  public encode() {
+    const payloads = this.messages.map(({ payload }) => ENCODER.encode(payload));
+    const buffer = new ArrayBuffer(4 + payloads.reduce((total, payload) => total + 2 + payload.byteLength, 0));
+
+    const header = new Uint8Array(buffer, 0, 4);
+    header.set([this.type, DataMessageType.BatchResponse, this.id, this.messages.length]);
+
+    let offset = 4;
+    for (const [index, payload] of payloads.entries()) {
+      new Uint8Array(buffer, offset, 2).set([this.messages[index].id2, payload.byteLength]);
+      new Uint8Array(buffer, offset + 2, payload.byteLength).set(payload);
+
+      offset += 2 + payload.byteLength;
+    }
+
+    return buffer;
+  }
+
+  public static decode(buffer: ArrayBuffer) {
+    const id = new Uint8Array(buffer, 2, 1);
+    const count = new Uint8Array(buffer, 3, 1);
+
+    const messages: DataPacket[] = [];
+
+    let offset = 4;
+    for (let index = 0; index < count[0]; index++) {
+      const [id2, length] = new Uint8Array(buffer, offset, 2);
+      const payload = new Uint8Array(buffer, offset + 2, length);
+
+      messages.push(new DataPacket(DataMessageType.GetResponse, id[0], id2, DECODER.decode(payload)));
+      offset += 2 + length;
+    }
+
+    return new BatchPacket(id[0], messages);
+  }
+}
@@ -0,0 +1,83 @@
+"""
+The ACKs the client has received, for the probing stages and the duplicate ACK check.
+
+Only the last `capacity` ACKs are kept, in a ring. Everything the client asks of them is kept
+up to date as they arrive, so every query is O(1) and the memory stays the same however long the
+transfer runs:
+
+- how many arrived since the current stage started, and the mean gap between them
+- how many there were in the shortest burst, where a gap long enough ends a burst
+- how many in a row repeated the latest sequence
+"""
+
+from math import inf
+from typing import TypeAlias
+
+Seq: TypeAlias = int
+Timestamp: TypeAlias = float
+Ack: TypeAlias = tuple[Timestamp, Seq]
+
+
+class AckHistory:
+    def __init__(self, capacity: int = 256):
+        self.capacity = capacity
+        self.times: list[Timestamp] = [-inf] * capacity
+        self.seqs: list[Seq] = [-1] * capacity
+        self.total = 0  # Ever appended, the next one goes in slot total % capacity
+
+        # The latest, and how many ACKs since the one that moved the sequence
+        self.at: Timestamp = -inf
+        self.seq: Seq = -1
+        self.duplicates = 0
+
+        self.mark()
+
+    def mark(self, burst_gap: float = inf):
+        """Starts a stage, which only counts the ACKs from here on. A gap of `burst_gap` or
+        more between two of them ends a burst."""
+        self.marked = self.total
+        self.first_at: Timestamp = -inf
+
+        self.burst_gap = burst_gap
+        self.burst = 0  # ACKs in the current one
+        self.shortest_burst: float = inf  # Of those that a gap has ended
+
+    def append(self, at: Timestamp, seq: Seq):
+        if self.total == self.marked:
+            self.first_at = at
+        elif at - self.at >= self.burst_gap:
+            self.shortest_burst = min(self.shortest_burst, self.burst)
+            self.burst = 0
+
+        self.burst += 1
+        self.duplicates = self.duplicates + 1 if seq == self.seq else 0
+
+        slot = self.total % self.capacity
+        self.times[slot] = at
+        self.seqs[slot] = seq
+        self.total += 1
+
+        self.at = at
+        self.seq = seq
+
+    @property
+    def count(self) -> int:
+        """ACKs since the stage started"""
+        return self.total - self.marked
+
+    @property
+    def mean_gap(self) -> float:
+        if self.count < 2:
+            return inf
+
+        # The gaps add up to the time between the first and the latest
+        return (self.at - self.first_at) / (self.count - 1)
+
+    def since_mark(self, i: int) -> Ack:
+        """The `i`th ACK of the stage, as long as it is one of the last `capacity`"""
+        index = self.marked + i
+        if not 0 <= i < self.count or index < self.total - self.capacity:
+            raise IndexError(f"ACK {i} of the stage is not in the history")
+
+        slot = index % self.capacity
+        return self.times[slot], self.seqs[slot]
@@ -0,0 +1,232 @@
+"""
+Reports on the packet traces that client.py, server-gbn.py and sim.py write with --trace.
+
+Traces of the client and of the emulator from the same run can be given together, they share a
+clock. Every figure is computed on whole columns with NumPy, so that traces of millions of
+events take seconds:
+
+- goodput over time, from the cumulative ACKs the client received
+- the distribution of the time from the first transmission of a sequence to the ACK covering it
+- queue occupancy, weighted by how long the queue stayed at each length
+- redundancy, how many transmissions it took per sequence delivered
+- loss bursts, runs of consecutive packets of a flow lost on their way into the queue
+"""
+
+from argparse import ArgumentParser
+from json import dumps
+
+import numpy as np
+
+from tracing import COLUMNS, HEADER, MAGIC, VERSION, Kind
+
+Columns = dict[str, np.ndarray]
+
+PERCENTILES = (50, 90, 99)
+
+
+def load(paths: list[str]) -> Columns:
+    """The events of every trace, in the order they happened"""
+    parts: list[Columns] = []
+    for path in paths:
+        raw = np.fromfile(path, dtype=np.uint8)
+        magic, version, count = HEADER.unpack_from(raw)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} trace")
+
+        offset = HEADER.size
+        part = {}
+        for name, _, dtype in COLUMNS:
+            part[name] = np.frombuffer(raw, dtype, count, offset)
+            offset += part[name].nbytes
+
+        parts.append(part)
+
+    columns = {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+    order = np.argsort(columns["time"], kind="stable")
+    return {name: column[order] for name, column in columns.items()}
+
+
+def select(columns: Columns, mask: np.ndarray) -> Columns:
+    return {name: column[mask] for name, column in columns.items()}
+
+
+def of_kind(columns: Columns, *kinds: Kind) -> Columns:
+    return select(columns, np.isin(columns["kind"], kinds))
+
+
+def percentiles(values: np.ndarray) -> dict:
+    if not len(values):
+        return {}
+
+    summary = {"min": values.min()}
+    for q, value in zip(PERCENTILES, np.percentile(values, PERCENTILES)):
+        summary[f"p{q}"] = value
+    summary["max"] = values.max()
+    summary["mean"] = values.mean()
+
+    return {name: float(value) for name, value in summary.items()}
+
+
+def goodput(acks: Columns, start: float, end: float, width: float) -> dict:
+    """Sequences delivered per second, overall and in every bin of `width` seconds"""
+    delivered = np.maximum.accumulate(acks["seq"]) + 1
+    edges = np.arange(start, end + width, width)
+
+    # How many had been delivered at the end of each bin
+    last = np.searchsorted(acks["time"], edges[1:], side="right") - 1
+    at_end = np.where(last >= 0, delivered[np.maximum(last, 0)], 0)
+    per_bin = np.diff(at_end, prepend=0) / width
+
+    return {
+        "delivered": int(delivered[-1]),
+        "packets_per_second": float(delivered[-1] / (acks["time"][-1] - start)),
+        "over_time": per_bin.tolist(),
+    }
+
+
+def rtt(sends: Columns, acks: Columns) -> dict:
+    """From the first transmission of every sequence to the first cumulative ACK covering it"""
+    seqs, first = np.unique(sends["seq"], return_index=True)
+    sent_at = sends["time"][first]
+
+    covered = np.maximum.accumulate(acks["seq"])
+    ack = np.searchsorted(covered, seqs, side="left")
+    answered = ack < len(covered)
+
+    # Stragglers of the probing stages can be covered before they are sent again
+    samples = acks["time"][ack[answered]] - sent_at[answered]
+    return percentiles(samples[samples >= 0])
+
+
+def redundancy(sends: Columns, parity: Columns, delivered: int) -> dict:
+    transmissions = len(sends["seq"]) + len(parity["seq"])
+    distinct = len(np.unique(sends["seq"]))
+    return {
+        "transmissions": transmissions,
+        "parity": len(parity["seq"]),
+        "repeats": len(sends["seq"]) - distinct,
+        "per_delivered": transmissions / delivered if delivered else float("inf"),
+        "efficiency": delivered / transmissions if transmissions else 0.0,
+    }
+
+
+def loss_bursts(arrivals: Columns) -> dict:
+    """Runs of consecutive packets that did not make it into the queue"""
+    lost = arrivals["kind"] != Kind.QUEUE
+    edges = np.diff(np.concatenate(([0], lost.view(np.int8), [0])))
+    lengths = np.flatnonzero(edges == -1) - np.flatnonzero(edges == 1)
+
+    counts = np.bincount(lengths)
+    return {
+        "dropped": int(np.count_nonzero(arrivals["kind"] == Kind.DROP)),
+        "overflowed": int(np.count_nonzero(arrivals["kind"] == Kind.OVERFLOW)),
+        "bursts": len(lengths),
+        "length": percentiles(lengths.astype(np.float64)),
+        "histogram": {int(n): int(counts[n]) for n in np.flatnonzero(counts)},
+    }
+
+
+def occupancy(queue: Columns, start: float, end: float, width: float) -> dict:
+    """The queue length over time, every event carries the length it left the queue at"""
+    times, lengths = queue["time"], queue["value"]
+    held = np.diff(times, append=times[-1])
+
+    bins = ((times - start) // width).astype(np.int64)
+    size = int((end - start) // width) + 1
+    weight = np.bincount(bins, weights=held, minlength=size)
+    total = np.bincount(bins, weights=held * lengths, minlength=size)
+
+    return {
+        "mean": float((held * lengths).sum() / held.sum()) if held.sum() else 0.0,
+        "max": int(lengths.max()),
+        "samples": percentiles(lengths.astype(np.float64)),
+        "over_time": np.divide(
+            total, weight, out=np.zeros(size), where=weight > 0
+        ).tolist(),
+    }
+
+
+def analyze(columns: Columns, width: float) -> dict:
+    start, end = float(columns["time"][0]), float(columns["time"][-1])
+    report: dict = {"events": len(columns["time"]), "duration": end - start, "flows": {}}
+
+    for flow in np.unique(columns["flow"]).tolist():
+        events = select(columns, columns["flow"] == flow)
+        sends = of_kind(events, Kind.SEND)
+        parity = of_kind(events, Kind.PARITY)
+        acks = of_kind(events, Kind.ACK)
+        arrivals = of_kind(events, Kind.DROP, Kind.OVERFLOW, Kind.QUEUE)
+
+        summary: dict = {}
+        if len(acks["time"]):
+            summary["goodput"] = goodput(acks, start, end, width)
+            summary["rtt"] = rtt(sends, acks)
+            delivered = summary["goodput"]["delivered"]
+            summary["redundancy"] = redundancy(sends, parity, delivered)
+        if len(arrivals["time"]):
+            summary["losses"] = loss_bursts(arrivals)
+
+        report["flows"][flow] = summary
+
+    queue = of_kind(columns, Kind.DROP, Kind.OVERFLOW, Kind.QUEUE, Kind.SERVE)
+    if len(queue["time"]):
+        report["queue"] = occupancy(queue, start, end, width)
+
+    return report
+
+
+def print_report(report: dict, width: float):
+    def line(indent: int, text: str):
+        print(" " * indent + text)
+
+    def distribution(summary: dict, scale: float = 1.0) -> str:
+        return ", ".join(f"{name} {value * scale:.2f}" for name, value in summary.items())
+
+    def series(values: list[float]) -> str:
+        return " ".join(f"{value:.0f}" for value in values)
+
+    line(0, f"{report['events']} events over {report['duration']:.3f}s")
+    for flow, summary in report["flows"].items():
+        line(0, f"flow {flow}")
+
+        if "goodput" in summary:
+            g, r = summary["goodput"], summary["redundancy"]
+            line(2, f"delivered {g['delivered']}, {g['packets_per_second']:.1f} packets/s")
+            line(4, f"per {width:g}s: {series(g['over_time'])}")
+            line(2, f"rtt ms: {distribution(summary['rtt'], 1000)}")
+            line(
+                2,
+                f"transmissions {r['transmissions']} ({r['parity']} parity, "
+                f"{r['repeats']} repeats), {r['per_delivered']:.2f} per delivered, "
+                f"efficiency {r['efficiency']:.1%}",
+            )
+
+        if "losses" in summary:
+            losses = summary["losses"]
+            line(
+                2,
+                f"dropped {losses['dropped']}, overflowed {losses['overflowed']} "
+                f"in {losses['bursts']} bursts",
+            )
+            line(4, f"burst length: {distribution(losses['length'])}")
+            histogram = losses["histogram"].items()
+            line(4, "bursts by length: " + ", ".join(f"{n}: {c}" for n, c in histogram))
+
+    if "queue" in report:
+        queue = report["queue"]
+        line(0, f"queue: mean {queue['mean']:.1f}, max {queue['max']}")
+        line(2, f"per {width:g}s: {series(queue['over_time'])}")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("traces", nargs="+", help="written with --trace")
+    parser.add_argument("--bin", type=float, default=0.5, help="seconds per time bin")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    report = analyze(load(args.traces), args.bin)
+    if args.json:
+        print(dumps(report))
+    else:
+        print_report(report, args.bin)
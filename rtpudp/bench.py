@@ -0,0 +1,229 @@
+"""
+Benchmarks the two senders, client.py and udp_client.py, end to end against the emulator.
+
+Every run starts server-gbn.py on a port picked by the OS, seeded so that both clients see the
+same drops, and runs one client against it. Runs go one at a time, since timings are the point,
+and the two clients take turns so that anything else slowing the machine down hits both. Every
+invocation is appended to a history file as one JSON line, and each row is compared with the last
+recorded run of the same scenario and client. A client that times out in a scenario is not run
+in it again, and the row says so rather than counting it with the runs that failed.
+
+udp_client.py needs Python 3.12 or later, so it runs with --udp-python, by default a python3.12
+found on the PATH. The emulator and client.py run with the interpreter running this script.
+"""
+
+import sys
+from argparse import ArgumentParser
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from json import dumps, loads
+from pathlib import Path
+from shutil import which
+from subprocess import TimeoutExpired, run
+
+from sweep import Point, emulate, summarize
+
+HERE = Path(__file__).resolve().parent
+
+
+@dataclass(frozen=True)
+class Scenario:
+    name: str
+    rtt: float = 0.1
+    drop_probability: float = 0.0
+    queue_size: int = 100
+    service_interval: float = 1 / 1000
+
+    @property
+    def point(self) -> Point:
+        return Point(
+            self.rtt,
+            self.drop_probability,
+            self.queue_size,
+            self.service_interval,
+            mode="gbn",
+        )
+
+
+SCENARIOS = {
+    scenario.name: scenario
+    for scenario in (
+        Scenario("clean"),
+        Scenario("loss", drop_probability=0.1),
+        Scenario("tiny-buffer", queue_size=10),
+        Scenario("long-rtt", rtt=0.5),
+    )
+}
+
+CLIENTS = {"client": "client.py", "udp_client": "udp_client.py"}
+
+METRICS = ("completion_time", "transmissions", "cpu_time", "wasted")
+
+
+def supports_udp_client(python: str) -> bool:
+    try:
+        version = run(
+            [python, "-c", "import sys; sys.exit(sys.version_info < (3, 12))"],
+            capture_output=True,
+        )
+    except OSError:
+        return False
+
+    return version.returncode == 0
+
+
+def run_once(
+    client: str, scenario: Scenario, seed: int, timeout: float, python: str
+) -> dict | None:
+    result = emulate(CLIENTS[client], scenario.point, seed, timeout, python)
+    if result is not None:
+        # Every transmission beyond the one that delivered each sequence
+        result["wasted"] = result["transmissions"] - result["delivered"]
+    return result
+
+
+def tabulate(
+    scenario: Scenario, client: str, results: list[dict | None], timeouts: int
+) -> dict:
+    done = [result for result in results if result is not None]
+
+    row = {"scenario": scenario.name, "client": client}
+    row["runs"] = len(done)
+    row["failures"] = len(results) - len(done)
+    row["timeouts"] = timeouts
+    for metric in METRICS:
+        row[metric], row[f"{metric}_ci"] = summarize([r[metric] for r in done])
+
+    return row
+
+
+def commit() -> str | None:
+    """The checked out commit of the code under test, if it is in a git repository"""
+    try:
+        head = run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=HERE,
+            capture_output=True,
+            text=True,
+        )
+    except OSError:
+        return None
+
+    return head.stdout.strip() if head.returncode == 0 else None
+
+
+def last_rows(path: Path) -> dict[tuple[str, str], dict]:
+    """The last recorded row of every scenario and client"""
+    rows = {}
+    if path.exists():
+        for line in path.read_text().splitlines():
+            for row in loads(line)["rows"]:
+                rows[row["scenario"], row["client"]] = row
+
+    return rows
+
+
+def print_table(rows: list[dict], previous: dict[tuple[str, str], dict]):
+    columns = [
+        ("scenario", "{}"),
+        ("client", "{}"),
+        ("runs", "{:d}"),
+        ("failures", "{:d}"),
+        ("timeouts", "{:d}"),
+        ("completion_time", "{:.3f}"),
+        ("completion_time_ci", "±{:.3f}"),
+        ("transmissions", "{:.1f}"),
+        ("transmissions_ci", "±{:.1f}"),
+        ("cpu_time", "{:.3f}"),
+        ("cpu_time_ci", "±{:.3f}"),
+        ("wasted", "{:.1f}"),
+        ("wasted_ci", "±{:.1f}"),
+    ]
+
+    cells = [[name for name, _ in columns] + ["vs_last"]]
+    for row in rows:
+        cells.append([spec.format(row[name]) for name, spec in columns])
+
+        # Relative change of the completion time since the last recorded run
+        last = previous.get((row["scenario"], row["client"]))
+        if last is None or not last["completion_time"] > 0:
+            cells[-1].append("")
+        else:
+            change = row["completion_time"] / last["completion_time"] - 1
+            cells[-1].append(f"{change:+.1%}")
+
+    widths = [max(len(row[i]) for row in cells) for i in range(len(cells[0]))]
+    for row in cells:
+        print("  ".join(cell.rjust(width) for cell, width in zip(row, widths)))
+
+
+def main(args):
+    pythons = {"client": sys.executable, "udp_client": args.udp_python}
+    scenarios = [SCENARIOS[name] for name in args.scenario]
+    history = Path(args.history)
+    previous = last_rows(history)
+
+    rows = []
+    for scenario in scenarios:
+        results: dict[str, list[dict | None]] = {client: [] for client in args.client}
+        timeouts = dict.fromkeys(args.client, 0)
+        for repeat in range(args.repeats):
+            for client in args.client:
+                if timeouts[client]:
+                    continue  # Another seed would only wait out the timeout again
+
+                try:
+                    result = run_once(
+                        client, scenario, args.seed + repeat, args.timeout, pythons[client]
+                    )
+                except TimeoutExpired:
+                    timeouts[client] += 1
+                else:
+                    results[client].append(result)
+
+        rows += [
+            tabulate(scenario, client, results[client], timeouts[client])
+            for client in args.client
+        ]
+
+    print_table(rows, previous)
+
+    record = {
+        "at": datetime.now().isoformat(timespec="seconds"),
+        "commit": commit(),
+        "python": sys.version.split()[0],
+        "udp_python": args.udp_python,
+        "repeats": args.repeats,
+        "seed": args.seed,
+        "scenarios": [asdict(scenario) for scenario in scenarios],
+        "rows": rows,
+    }
+    with history.open("a") as file:
+        print(dumps(record), file=file)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--scenario", choices=SCENARIOS, nargs="+", default=list(SCENARIOS)
+    )
+    parser.add_argument("--client", choices=CLIENTS, nargs="+", default=list(CLIENTS))
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=120, help="seconds per run")
+    parser.add_argument(
+        "--udp-python",
+        default=which("python3.12") or sys.executable,
+        help="interpreter for udp_client.py, which needs Python 3.12 or later",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="repeat i uses seed + i")
+    parser.add_argument(
+        "--history",
+        default="bench-history.jsonl",
+        help="file to append the results to as JSON lines, and compare against",
+    )
+    args = parser.parse_args()
+
+    if "udp_client" in args.client and not supports_udp_client(args.udp_python):
+        parser.error("udp_client.py needs Python 3.12 or later, set --udp-python")
+
+    main(args)
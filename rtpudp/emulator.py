@@ -0,0 +1,531 @@
+import socket
+from asyncio import AbstractEventLoop, TimerHandle, get_running_loop
+from asyncio.protocols import DatagramProtocol
+from asyncio.transports import DatagramTransport
+from collections import deque
+from collections.abc import Callable
+from logging import getLogger
+from random import Random
+from struct import Struct, error
+from typing import TypeAlias
+
+from eventlog import EventLog
+from payload import CHUNK, SIZE, Sink
+from tracing import Kind, Trace
+
+logger = getLogger(__name__)
+
+# Logged for every packet, kept off the hot paths once the event log is started
+events = EventLog(logger)
+log_arrived = events.event("arrived", "Packet %d added to delay line, expected at %f")
+log_dropped = events.event("dropped", "Packet %r dropped before entering queue")
+log_overflowed = events.event("overflowed", "Packet %r dropped due to full buffer")
+log_queued = events.event("queued", "Packet %r added to queue at %f")
+log_served = events.event("served", "Processed packet %r, sent cumulative ACK %d")
+log_recovered = events.event("recovered", "Recovered packet %d from parity of %d")
+
+Seq: TypeAlias = int
+Timestamp: TypeAlias = float
+Address: TypeAlias = tuple[str, int]
+
+SEQ = Struct("!I")
+
+# Selective repeat ACKs are followed by a little endian bitmap, bit i set means base + 2 + i was
+# received. Packets more than SACK_WINDOW past base are discarded.
+SACK_WINDOW = 256
+
+# Parity packets have the top bit of the sequence set and the rest is the first sequence of their
+# block. Then come the number of packets in the block, the XOR of their sequences and, if they
+# carry chunks of a file, the little endian XOR of the chunks.
+PARITY = 1 << 31
+PARITY_HEADER = Struct("!IB")
+PAYLOAD_HEADER = Struct(SEQ.format + SIZE.format[1:])
+
+Packet: TypeAlias = Seq | bytes  # Parity packets and packets with a payload are kept whole
+
+
+class Flow:
+    """Receiver state and statistics of one sender, keyed by its address"""
+
+    def __init__(self, addr: Address, started_at: Timestamp):
+        self.addr = addr
+        self.base: Seq = -1  # Last in-order received packet
+        self.sacks = 0  # Bit i set means base + 1 + i was received
+
+        self.queue: deque[Packet] = deque()  # Only used by DRRScheduler
+        self.deficit = 0
+
+        self.started_at = started_at
+        self.last_ack_at = started_at
+
+        self.received = 0  # Datagrams that reached the link
+        self.dropped = 0  # Randomly dropped before the queue
+        self.overflowed = 0  # Dropped because the queue was full
+        self.served = 0
+        self.out_of_order = 0  # Served but discarded, duplicates or outside the window
+        self.recovered = 0  # Rebuilt from parity packets
+
+        self.sink: Sink | None = None  # Where the payloads go, if they are kept
+        self.finished = False  # The whole payload is in the sink
+
+    def stats(self) -> dict:
+        elapsed = self.last_ack_at - self.started_at
+        delivered = self.base + 1
+        return {
+            "addr": f"{self.addr[0]}:{self.addr[1]}",
+            "received": self.received,
+            "dropped": self.dropped,
+            "overflowed": self.overflowed,
+            "served": self.served,
+            "out_of_order": self.out_of_order,
+            "recovered": self.recovered,
+            "delivered": delivered,
+            "elapsed": elapsed,
+            # Packets per second
+            "goodput": delivered / elapsed if elapsed > 0 else 0.0,
+        }
+
+
+class FIFOScheduler:
+    """One queue shared by every flow, served in arrival order"""
+
+    def __init__(self):
+        self.queue: deque[tuple[Flow, Packet]] = deque()
+
+    def __len__(self):
+        return len(self.queue)
+
+    def push(self, flow: Flow, packet: Packet):
+        self.queue.append((flow, packet))
+
+    def pop(self) -> tuple[Flow, Packet]:
+        return self.queue.popleft()
+
+
+class DRRScheduler:
+    """
+    Deficit round robin over the flows with packets queued, each gets `quantum` packets per turn.
+    Every packet takes the same time to serve so the deficit is counted in packets.
+    """
+
+    def __init__(self, quantum: int = 1):
+        self.quantum = quantum
+        self.active: deque[Flow] = deque()
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def push(self, flow: Flow, packet: Packet):
+        if not flow.queue:
+            self.active.append(flow)
+
+        flow.queue.append(packet)
+        self.length += 1
+
+    def pop(self) -> tuple[Flow, Packet]:
+        flow = self.active[0]
+        if flow.deficit == 0:  # Start of its turn
+            flow.deficit = self.quantum
+
+        flow.deficit -= 1
+        packet = flow.queue.popleft()
+        self.length -= 1
+
+        if not flow.queue:
+            flow.deficit = 0
+            self.active.popleft()
+        elif flow.deficit == 0:
+            self.active.rotate(-1)
+
+        return flow, packet
+
+
+SCHEDULERS = {"fifo": FIFOScheduler, "drr": DRRScheduler}
+
+CHANGEABLE = {
+    "rtt": float,
+    "service_interval": float,
+    "drop_probability": float,
+    "queue_size": int,
+}
+
+
+def parse_change(change: str) -> tuple[float, dict]:
+    """`3.5:rtt=0.2,drop_probability=0.05` changes those 3.5 seconds after the start"""
+    at, _, settings = change.partition(":")
+    changes = dict(setting.split("=", 1) for setting in settings.split(","))
+    for name, value in changes.items():
+        if name not in CHANGEABLE:
+            raise ValueError(f"{name} can not be changed")
+
+        changes[name] = CHANGEABLE[name](value)
+
+    return float(at), changes
+
+
+class LinkEmulator(DatagramProtocol):
+    """
+    Emulates the bottleneck link in front of a Go-Back-N, or with `selective` a selective repeat,
+    receiver per sender.
+
+    Every datagram goes through a delay line of `rtt`, is dropped with `drop_probability`,
+    waits in a queue of at most `queue_size` packets shared by all flows and is served once every
+    `service_interval`, which sends back the cumulative ACK of its flow. The scheduler decides
+    which flow is served next. A parity packet takes a slot like any other and rebuilds the one
+    packet of its block that is missing, if only one is. With `output`, the payloads of every
+    flow are written to a file named after it, see `payload.py`, and with `trace` every packet
+    is recorded as it arrives, is dropped, queued or served.
+
+    Everything runs on the event loop with at most two timers armed at a time. Since every packet
+    is delayed by the same amount the delay line is a deque ordered by release time, and service
+    is scheduled against absolute deadlines so that timer jitter never accumulates.
+    """
+
+    def __init__(
+        self,
+        rtt: float,
+        service_interval: float,
+        drop_probability: float,
+        queue_size: int,
+        scheduler: FIFOScheduler | DRRScheduler | None = None,
+        rng: Random | None = None,
+        selective: bool = False,
+        output: str | None = None,
+        trace: Trace | None = None,
+    ):
+        self.rtt = rtt
+        self.service_interval = service_interval
+        self.drop_probability = drop_probability
+        self.queue_size = queue_size
+        self.random = (rng or Random()).random
+        self.window = SACK_WINDOW if selective else 1  # Go-Back-N only takes base + 1
+        self.output = output  # Formatted with the ip and port of the flow
+        self.trace = trace
+
+        self.transport: DatagramTransport | None = None
+        self.loop: AbstractEventLoop | None = None
+
+        self.flows: dict[Address, Flow] = {}
+        self.delay_line: deque[tuple[Timestamp, Packet, Flow]] = deque()
+        self.queue = FIFOScheduler() if scheduler is None else scheduler
+
+        self.release_timer: TimerHandle | None = None
+        self.service_timer: TimerHandle | None = None
+        self.next_service: Timestamp = -float("inf")
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.loop = get_running_loop()
+
+    def datagram_received(self, data: bytes, addr: Address):
+        assert self.loop is not None
+
+        try:
+            (seq,) = SEQ.unpack_from(data)
+        except Exception:
+            logger.warning("Malformed packet from %s", addr)
+            return
+
+        packet: Packet = data if seq & PARITY or len(data) > SEQ.size else seq
+        now = self.loop.time()
+
+        flow = self.flows.get(addr)
+        if flow is None:
+            flow = self.flows[addr] = Flow(addr, now)
+            logger.info("New flow from %s:%d", *addr)
+
+        flow.received += 1
+        if self.trace is not None:
+            self.trace.record(now, Kind.ARRIVE, addr[1], seq)
+
+        departs_at = now + self.rtt
+        if self.delay_line and departs_at < self.delay_line[-1][0]:
+            departs_at = self.delay_line[-1][0]  # The rtt went down, nothing overtakes
+
+        self.delay_line.append((departs_at, packet, flow))
+        log_arrived(seq, departs_at)
+
+        if self.release_timer is None:
+            self.release_timer = self.loop.call_at(departs_at, self.release)
+
+    def release(self):
+        """Moves every packet that has spent `rtt` in the delay line into the queue"""
+        assert self.loop is not None
+
+        self.release_timer = None
+
+        now = self.loop.time()
+        delay_line = self.delay_line
+        while delay_line and delay_line[0][0] <= now:
+            _, packet, flow = delay_line.popleft()
+
+            # Simulate random drop before entering queue
+            if self.random() < self.drop_probability:
+                flow.dropped += 1
+                log_dropped(packet)
+                self.record(now, Kind.DROP, flow, packet)
+                continue
+
+            if len(self.queue) >= self.queue_size:
+                flow.overflowed += 1
+                log_overflowed(packet)
+                self.record(now, Kind.OVERFLOW, flow, packet)
+                continue
+
+            self.queue.push(flow, packet)
+            log_queued(packet, now)
+            self.record(now, Kind.QUEUE, flow, packet)
+
+        if delay_line:
+            self.release_timer = self.loop.call_at(delay_line[0][0], self.release)
+
+        if self.queue and self.service_timer is None:
+            # An idle link serves immediately, a busy one stays on its own schedule
+            self.next_service = max(self.next_service, now)
+            self.serve()
+
+    def serve(self):
+        """Serves every packet whose service slot has come, one per `service_interval`"""
+        assert self.loop is not None
+
+        self.service_timer = None
+
+        now = self.loop.time()
+        queue = self.queue
+        while queue and self.next_service <= now:
+            flow, packet = queue.pop()
+            self.acknowledge(flow, packet, now)
+
+            self.next_service += self.service_interval
+
+        if queue:
+            self.service_timer = self.loop.call_at(self.next_service, self.serve)
+
+    def acknowledge(self, flow: Flow, packet: Packet, now: Timestamp):
+        assert self.transport is not None
+
+        flow.served += 1
+
+        if isinstance(packet, int):
+            seq, chunk = packet, None
+        elif SEQ.unpack_from(packet)[0] & PARITY:
+            seq, chunk = self.recover(flow, packet)
+        else:
+            seq, chunk = self.unpack(flow, packet)
+
+        offset = -1 if seq is None else seq - flow.base - 1
+        if 0 <= offset < self.window and not flow.sacks >> offset & 1:
+            flow.sacks |= 1 << offset
+            if chunk is not None and flow.sink is not None:
+                flow.sink.write(seq, chunk)
+
+            # Update cumulative ACK base
+            while flow.sacks & 1:
+                flow.sacks >>= 1
+                flow.base += 1
+
+            if flow.sink is not None and flow.base + 1 >= len(flow.sink):
+                self.complete(flow, now)
+        else:
+            flow.out_of_order += 1
+
+        # Send cumulative ACK, nothing has been received before the first packet
+        if flow.base >= 0:
+            ack = SEQ.pack(flow.base)
+            if self.window > 1:
+                ack += (flow.sacks >> 1).to_bytes(SACK_WINDOW // 8, "little")
+
+            self.transport.sendto(ack, flow.addr)
+            flow.last_ack_at = now
+
+        log_served(packet, flow.base)
+        self.record(now, Kind.SERVE, flow, packet)
+
+    def record(self, now: Timestamp, kind: Kind, flow: Flow, packet: Packet):
+        """Traces a packet along with the queue length it leaves behind"""
+        if self.trace is not None:
+            seq = packet if isinstance(packet, int) else SEQ.unpack_from(packet)[0]
+            self.trace.record(now, kind, flow.addr[1], seq, len(self.queue))
+
+    def received(self, flow: Flow, seq: Seq) -> bool:
+        offset = seq - flow.base - 1
+        return offset < 0 or (offset < self.window and flow.sacks >> offset & 1 == 1)
+
+    def unpack(self, flow: Flow, packet: bytes) -> tuple[Seq | None, memoryview | None]:
+        """The sequence and chunk of a packet with a payload"""
+        try:
+            seq, size = PAYLOAD_HEADER.unpack_from(packet)
+        except error:
+            logger.warning("Malformed packet from %s", flow.addr)
+            return None, None
+
+        if flow.sink is None and self.output is not None:
+            path = self.output.format(ip=flow.addr[0], port=flow.addr[1])
+            flow.sink = Sink(path, size)
+            logger.info("Receiving %d bytes from %s:%d into %s", size, *flow.addr, path)
+
+        return seq, memoryview(packet)[PAYLOAD_HEADER.size :]
+
+    def recover(self, flow: Flow, parity: bytes) -> tuple[Seq | None, bytes | None]:
+        """The packet a parity packet rebuilds, nothing if its block is complete or lost two"""
+        try:
+            header, count = PARITY_HEADER.unpack_from(parity)
+            (seq,) = SEQ.unpack_from(parity, PARITY_HEADER.size)
+        except error:
+            logger.warning("Malformed parity packet from %s", flow.addr)
+            return None, None
+
+        first = header & ~PARITY
+        block = range(first, first + count)
+        missing = [other for other in block if not self.received(flow, other)]
+        if len(missing) != 1:
+            return None, None
+
+        # XOR the packets that were received out of the parity
+        others = [other for other in block if other != missing[0]]
+        for other in others:
+            seq ^= other
+
+        chunk = None
+        body = memoryview(parity)[PARITY_HEADER.size + SEQ.size :]
+        if body and flow.sink is not None:
+            data = int.from_bytes(body, "little")
+            for other in others:
+                data ^= int.from_bytes(flow.sink.chunk(other), "little")
+
+            chunk = data.to_bytes(CHUNK, "little")
+
+        flow.recovered += 1
+        log_recovered(seq, first)
+        if self.trace is not None and self.loop is not None:
+            self.trace.record(self.loop.time(), Kind.RECOVER, flow.addr[1], seq)
+
+        return seq, chunk
+
+    def complete(self, flow: Flow, now: Timestamp):
+        assert flow.sink is not None
+
+        if flow.finished:
+            return
+
+        flow.finished = True
+        elapsed = now - flow.started_at
+        logger.info(
+            "Received %s from %s:%d, %d bytes in %.3fs (%.3f MB/s), sha256 %s",
+            flow.sink.path,
+            *flow.addr,
+            flow.sink.size,
+            elapsed,
+            flow.sink.size / elapsed / 1e6 if elapsed > 0 else 0.0,
+            flow.sink.checksum(),
+        )
+
+    def change(self, settings: dict):
+        """Changes the link mid-run, see CHANGEABLE for what can be changed"""
+        for name, value in settings.items():
+            if name not in CHANGEABLE:
+                raise ValueError(f"{name} can not be changed")
+
+            setattr(self, name, CHANGEABLE[name](value))
+
+        logger.info("Link changed: %s", settings)
+
+    def stats(self) -> list[dict]:
+        return [flow.stats() for flow in self.flows.values()]
+
+    def error_received(self, exc):
+        logger.warning("Error received: %s", exc)
+
+    def connection_lost(self, exc):
+        for timer in (self.release_timer, self.service_timer):
+            if timer is not None:
+                timer.cancel()
+
+        for flow in self.flows.values():
+            if flow.sink is not None:
+                flow.sink.close()
+
+
+class BatchedDatagramTransport(DatagramTransport):
+    """
+    asyncio's datagram transport reads one datagram per wakeup of the event loop, which costs a
+    poll and a callback for every packet. This one drains the socket every time it is readable.
+    """
+
+    MAX_BATCH = 1024  # Datagrams per wakeup, so that timers still get to run under flood
+    RECEIVE_BUFFER = 1 << 22
+
+    def __init__(
+        self, loop: AbstractEventLoop, sock: socket.socket, protocol: DatagramProtocol
+    ):
+        super().__init__({"socket": sock, "sockname": sock.getsockname()})
+        self.loop = loop
+        self.sock = sock
+        self.protocol = protocol
+        self.closing = False
+
+        loop.add_reader(sock.fileno(), self.read_ready)
+        loop.call_soon(protocol.connection_made, self)
+
+    def read_ready(self):
+        recvfrom = self.sock.recvfrom
+        datagram_received = self.protocol.datagram_received
+        for _ in range(self.MAX_BATCH):
+            try:
+                data, addr = recvfrom(2048)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as exc:
+                self.protocol.error_received(exc)
+                return
+
+            datagram_received(data, addr)
+
+    def sendto(self, data, addr=None):
+        if self.closing:
+            return
+
+        try:
+            self.sock.sendto(data, addr)
+        except (BlockingIOError, InterruptedError):
+            pass  # Same as a drop on the wire
+        except OSError as exc:
+            self.protocol.error_received(exc)
+
+    def is_closing(self):
+        return self.closing
+
+    def close(self):
+        if self.closing:
+            return
+
+        self.closing = True
+        self.loop.remove_reader(self.sock.fileno())
+        self.sock.close()
+        self.loop.call_soon(self.protocol.connection_lost, None)
+
+    def abort(self):
+        self.close()
+
+
+async def create_endpoint(
+    protocol_factory: Callable[[], DatagramProtocol], local_addr: Address
+) -> tuple[BatchedDatagramTransport, DatagramProtocol]:
+    """Same as `loop.create_datagram_endpoint(protocol_factory, local_addr=local_addr)`"""
+    loop = get_running_loop()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        # Room for bursts while the loop is busy serving
+        sock.setsockopt(
+            socket.SOL_SOCKET, socket.SO_RCVBUF, BatchedDatagramTransport.RECEIVE_BUFFER
+        )
+        sock.setblocking(False)
+        sock.bind(local_addr)
+    except OSError:
+        sock.close()
+        raise
+
+    protocol = protocol_factory()
+    return BatchedDatagramTransport(loop, sock, protocol), protocol
@@ -0,0 +1,238 @@
+"""
+Online estimates of the link, updated on every send and every ACK.
+
+The client used to probe the RTT, service time and buffer once and then trust those numbers for
+the whole transfer. These keep tracking them so that pacing and redundancy follow the link when
+it changes mid-transfer.
+"""
+
+from collections import deque
+from math import inf
+from typing import TypeAlias
+
+Seq: TypeAlias = int
+Timestamp: TypeAlias = float
+
+
+class WindowedMin:
+    """Minimum of the samples from the last `window` of `now`, amortized O(1) per sample"""
+
+    def __init__(self, window: float):
+        self.window = window
+        self.samples: deque[tuple[Timestamp, float]] = deque()  # Increasing values
+
+    def update(self, value: float, now: Timestamp):
+        samples = self.samples
+        while samples and samples[-1][1] >= value:
+            samples.pop()
+
+        samples.append((now, value))
+        while samples[0][0] < now - self.window:
+            samples.popleft()
+
+    @property
+    def value(self) -> float:
+        return self.samples[0][1] if self.samples else inf
+
+
+class RttEstimator:
+    """
+    Samples are the time from the first transmission of a sequence to the ACK that covers it.
+    `min` is the windowed minimum, the RTT without queueing, and `smoothed` an EWMA that includes
+    it. A lost first copy only makes a sample larger, which the minimum ignores. `timeout` is how
+    long an ACK can take before it is late, as in RFC 6298.
+    """
+
+    def __init__(self, gain: float = 1 / 8, window: float = 2.0):
+        self.gain = gain
+        self.smoothed = inf
+        self.deviation = 0.0
+        self.filter = WindowedMin(window)
+
+    def update(self, sample: float, now: Timestamp):
+        if self.smoothed == inf:
+            self.smoothed = sample
+            self.deviation = sample / 2
+        else:
+            error = sample - self.smoothed
+            self.smoothed += self.gain * error
+            self.deviation += 2 * self.gain * (abs(error) - self.deviation)
+
+        self.filter.update(sample, now)
+
+    @property
+    def timeout(self) -> float:
+        return self.smoothed + 4 * self.deviation
+
+    @property
+    def min(self) -> float:
+        return self.filter.value
+
+
+class ServiceEstimator:
+    """
+    The server sends one ACK per packet it serves, so two packets that reach its queue together
+    are ACKed exactly one service interval apart, and no two ACKs are ever closer than that. The
+    sender paces in pairs to make sure there are such gaps, and the minimum of the last `window`
+    gaps picks them. That window is counted in gaps rather than seconds, as a window in time
+    that is shorter than a pause in the ACKs would be left with nothing but the pause.
+    Gaps much shorter than the estimate are ACKs that were sent or read together and are ignored.
+    """
+
+    def __init__(self, window: int = 32, floor: float = 1 / 4):
+        self.filter = WindowedMin(window)
+        self.floor = floor
+        self.gaps = 0
+        self.last_ack_at: Timestamp | None = None
+
+    def update(self, now: Timestamp):
+        if self.last_ack_at is not None:
+            gap = now - self.last_ack_at
+            if 0 < gap and (gap >= self.floor * self.interval or self.interval == inf):
+                self.gaps += 1
+                self.filter.update(gap, self.gaps)
+
+        self.last_ack_at = now
+
+    @property
+    def interval(self) -> float:
+        return self.filter.value
+
+
+class LossEstimator:
+    """
+    Fraction of the last `window` transmissions that were not served. The server serves each flow
+    in order and ACKs every packet it serves, so the ACKs answer transmissions in the order they
+    were sent: one that moves the base answers a transmission of the sequence after the old base,
+    any other one a transmission of something else, and the transmissions before the one it
+    answers were lost. A parity packet can stand in for either, which at worst swaps which of two
+    transmissions is counted as lost.
+
+    Sends and ACKs are counted over the same transmissions. As with the service time, the window
+    is counted in transmissions rather than seconds, so that a flow that sends little still has
+    enough of them.
+    """
+
+    def __init__(self, window: int = 256):
+        self.window = window
+        self.in_flight: deque[Seq | None] = deque()  # Parity packets carry no sequence
+        self.outcomes: deque[bool] = deque()  # Whether each was lost
+        self.lost = 0  # Among the outcomes
+
+    def forget(self):
+        """
+        Counts only what is sent from now on, as after probing overflowed the queue on purpose. The
+        ACKs for everything sent so far must be in, what is still in flight was lost, and would
+        otherwise be taken for the first copies of the sequences sent next.
+        """
+        self.in_flight.clear()
+        self.outcomes.clear()
+        self.lost = 0
+
+    def on_send(self, seq: Seq | None):
+        self.in_flight.append(seq)
+
+    def on_ack(self, expected: Seq, moved: bool):
+        """`expected` is the sequence after the base before this ACK, `moved` whether it moved"""
+        in_flight = self.in_flight
+        for skipped, seq in enumerate(in_flight):
+            if seq is None or (seq == expected) == moved:
+                break
+        else:
+            # Nothing fits, count it as answering the oldest rather than losing them all
+            skipped = 0
+
+        for _ in range(skipped):
+            in_flight.popleft()
+            self.resolve(True)
+        if in_flight:
+            in_flight.popleft()
+            self.resolve(False)
+
+    def resolve(self, lost: bool):
+        self.outcomes.append(lost)
+        self.lost += lost
+        if len(self.outcomes) > self.window:
+            self.lost -= self.outcomes.popleft()
+
+    @property
+    def rate(self) -> float:
+        if not self.outcomes:
+            return 0.0
+
+        return self.lost / len(self.outcomes)
+
+
+class LinkEstimator:
+    """Everything the sender needs to know about the link, fed by `on_send` and `on_ack`"""
+
+    def __init__(self, loss_window: int = 256, rtt_window: float = 2.0):
+        self.rtt = RttEstimator(window=rtt_window)
+        self.service = ServiceEstimator()
+        self.loss = LossEstimator(loss_window)
+
+        self.first_sent_at: dict[Seq, Timestamp] = {}
+        self.retransmitted: set[Seq] = set()
+        self.highest: Seq = -1
+        self.base: Seq = -1
+
+    def on_send(self, seq: Seq, now: Timestamp):
+        # Copies of the newest sequence go out within an RTT and count as one transmission,
+        # sending anything older again makes its ACK ambiguous (Karn's algorithm). So does
+        # resending the newest one after a rewind, which would sample the whole timeout
+        if seq < self.highest or now - self.first_sent_at.get(seq, now) > self.rtt.min:
+            self.retransmitted.add(seq)
+        self.highest = max(self.highest, seq)
+
+        self.first_sent_at.setdefault(seq, now)
+        self.loss.on_send(seq)
+
+    def on_parity(self, now: Timestamp):
+        """Parity packets carry no sequence but are served and ACKed like the rest"""
+        self.loss.on_send(None)
+
+    def on_ack(self, seq: Seq, now: Timestamp):
+        self.service.update(now)
+        self.loss.on_ack(self.base + 1, seq > self.base)
+
+        if seq > self.base:
+            # Whatever the mode, the packet that moved the base forward is the one after it
+            sent_at = self.first_sent_at.get(self.base + 1)
+            if sent_at is not None and self.base + 1 not in self.retransmitted:
+                self.rtt.update(now - sent_at, now)
+
+            for acked in range(self.base + 1, seq + 1):
+                self.first_sent_at.pop(acked, None)
+                self.retransmitted.discard(acked)
+
+            self.base = seq
+
+
+class WindowEstimator:
+    """
+    Packets to keep in flight, which with the service time sets the pacing interval. It starts at
+    the probed buffer, which a flow that probes while others fill the queue gets far too small,
+    and moves by one per round trip as in TCP Vegas: while the packets the flow keeps queued,
+    `window` times the share of the smoothed RTT spent queueing, are fewer than `low` there is
+    room to send more, past `high` the queue is filling up. Never less than one packet, nor more
+    than it takes to send once every service interval.
+    """
+
+    def __init__(self, buf: int, low: float = 1, high: float = 3):
+        self.value = float(buf)
+        self.low = low
+        self.high = high
+
+    def update(self, rtt: RttEstimator, prc: float):
+        """Once per packet sent, so that a whole window of them moves it by one"""
+        smoothed, base = rtt.smoothed, rtt.min
+        if smoothed == inf or base == inf:
+            return
+
+        queued = self.value * (smoothed - base) / smoothed
+        if queued < self.low:
+            self.value += 1 / self.value
+        elif queued > self.high:
+            self.value -= 1 / self.value
+
+        self.value = min(max(self.value, 1.0), (base + prc) / prc)
@@ -0,0 +1,183 @@
+"""
+Logging for the events on the hot paths, every packet sent, queued, served or ACKed.
+
+A logger call builds a record and formats and writes it on the spot, which costs more than the
+send it is logging and lands in the middle of the pacing and service timings. An `Event` only
+appends its arguments to a ring buffer, and a background thread turns them into log records, or
+into unformatted lines in a file of their own, a batch at a time. Every kind of event can be
+sampled, and until the log is started events go to the logger as they happen.
+"""
+
+from argparse import ArgumentParser, ArgumentTypeError, Namespace
+from collections import deque
+from collections.abc import Mapping
+from logging import DEBUG, Logger, LogRecord
+from threading import Event as Flag
+from threading import Thread
+from time import time
+from typing import TextIO
+
+
+class Event:
+    """One kind of event, called with the arguments of its message every time it happens"""
+
+    __slots__ = ("log", "kind", "message", "level", "every", "seen")
+
+    def __init__(self, log: "EventLog", kind: str, message: str, level: int):
+        self.log = log
+        self.kind = kind
+        self.message = message
+        self.level = level
+
+        self.every = 1  # Keeps one in this many, none if 0
+        self.seen = 0
+
+    def __call__(self, *args):
+        if self.every != 1:
+            self.seen += 1
+            if not self.every or self.seen % self.every:
+                return
+
+        ring = self.log.ring
+        if ring is None:
+            self.log.logger.log(self.level, self.message, *args, stacklevel=2)
+        else:
+            ring.append((time(), self, args))
+
+
+class EventLog:
+    """
+    The events of one logger. Once started they are kept in a ring of `capacity`, where the
+    oldest are overwritten if the writer falls that far behind, and written every `interval`
+    seconds. Formatting and I/O happen on the writer's thread, in batches.
+    """
+
+    def __init__(self, logger: Logger, capacity: int = 1 << 16):
+        self.logger = logger
+        self.capacity = capacity
+        self.events: dict[str, Event] = {}
+
+        self.ring: deque | None = None
+        self.file: TextIO | None = None
+        self.stopped = Flag()
+        self.writer: Thread | None = None
+
+    def event(self, kind: str, message: str, level: int = DEBUG) -> Event:
+        event = self.events[kind] = Event(self, kind, message, level)
+        return event
+
+    def start(
+        self,
+        sync: bool = False,
+        sample: Mapping[str, int] = {},
+        path: str | None = None,
+        interval: float = 0.1,
+    ):
+        """
+        Keeps one in `sample[kind]` events of each kind. Unless `sync`, they are buffered and
+        written in the background, as plain lines of a timestamp, the kind and the arguments
+        to `path` if there is one and through the logger otherwise. Events written as they
+        happen only go through the logger, so `sync` takes no `path`.
+        """
+        if sync and path is not None:
+            raise ValueError("Events logged as they happen cannot go to a file of their own")
+
+        for event in self.events.values():
+            event.every = sample.get(event.kind, 1)
+            event.seen = 0
+
+            # Buffering what the logger would discard only to discard it later
+            if path is None and not self.logger.isEnabledFor(event.level):
+                event.every = 0
+
+        if sync:
+            return
+
+        if path is not None:
+            self.file = open(path, "w")
+
+        self.ring = deque(maxlen=self.capacity)
+        self.stopped.clear()
+        self.writer = Thread(target=self.run, args=(interval,), daemon=True)
+        self.writer.start()
+
+    def stop(self):
+        """Writes what is left and goes back to logging events as they happen"""
+        if self.writer is None:
+            return
+
+        self.stopped.set()
+        self.writer.join()
+        self.writer = None
+        self.ring = None
+
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def run(self, interval: float):
+        while not self.stopped.wait(interval):
+            self.flush()
+
+        self.flush()
+
+    def flush(self):
+        ring = self.ring
+        if not ring:
+            return
+
+        # Only this thread takes events out, the hot paths keep appending meanwhile
+        batch = [ring.popleft() for _ in range(len(ring))]
+
+        if self.file is not None:
+            self.file.writelines(
+                f"{created:.6f} {event.kind} {' '.join(map(str, args))}\n"
+                for created, event, args in batch
+            )
+            self.file.flush()
+            return
+
+        logger = self.logger
+        for created, event, args in batch:
+            record = LogRecord(
+                logger.name, event.level, "", 0, event.message, args, None
+            )
+            record.created = created
+            record.msecs = (created - int(created)) * 1000
+            logger.handle(record)
+
+
+def parse_sample(value: str) -> tuple[str, int]:
+    """KIND=N, as in `--log-sample sent=10`"""
+    kind, _, every = value.partition("=")
+    try:
+        return kind, int(every)
+    except ValueError:
+        raise ArgumentTypeError(f"expected KIND=N, got {value!r}") from None
+
+
+def add_arguments(parser: ArgumentParser):
+    parser.add_argument(
+        "--log-events",
+        choices=("ring", "sync"),
+        default="ring",
+        help="log the per packet events from a background thread, or as they happen",
+    )
+    parser.add_argument(
+        "--log-sample",
+        type=parse_sample,
+        action="append",
+        default=[],
+        metavar="KIND=N",
+        help="log one in N events of this kind, none if N is 0",
+    )
+    parser.add_argument(
+        "--event-log",
+        metavar="PATH",
+        help="write the events unformatted to this file, only from the background thread",
+    )
+
+
+def start_from_arguments(log: EventLog, args: Namespace):
+    """Starts the event log as the options from `add_arguments` say"""
+    log.start(args.log_events == "sync", dict(args.log_sample), args.event_log)
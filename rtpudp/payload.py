@@ -0,0 +1,90 @@
+"""
+File contents carried by the data packets, one fixed size chunk per sequence.
+
+A data packet with a payload is its sequence, the size of the whole file and the chunk. The
+sender memory maps the file and sends views into the map, and the receiver writes every chunk
+into a memory mapped output file of the final size. A chunk is only copied when it goes out in a
+`sendmmsg` batch, which is joined into one buffer.
+"""
+
+import mmap
+from hashlib import sha256
+from math import ceil
+from struct import Struct
+from typing import TypeAlias
+
+Seq: TypeAlias = int
+
+CHUNK = 1024  # Bytes per packet, a datagram stays well under the MTU
+SIZE = Struct("!Q")  # Follows the sequence
+
+
+def open_map(file, size: int, access: int) -> mmap.mmap | None:
+    # Empty files can not be mapped
+    return mmap.mmap(file.fileno(), size, access=access) if size else None
+
+
+def checksum(data) -> str:
+    return sha256(data if data is not None else b"").hexdigest()
+
+
+class Source:
+    """The file being sent, every chunk a view into its memory map"""
+
+    def __init__(self, path: str):
+        with open(path, "rb") as file:
+            file.seek(0, 2)
+            self.size = file.tell()
+            self.map = open_map(file, self.size, mmap.ACCESS_READ)
+
+        self.view = memoryview(self.map if self.map is not None else b"")
+        self.header = SIZE.pack(self.size)
+
+    def __len__(self):
+        return ceil(self.size / CHUNK)
+
+    def chunk(self, seq: Seq) -> memoryview:
+        return self.view[seq * CHUNK : (seq + 1) * CHUNK]
+
+    def checksum(self) -> str:
+        return checksum(self.map)
+
+    def close(self):
+        self.view.release()
+        if self.map is not None:
+            self.map.close()
+
+
+class Sink:
+    """The file being received, preallocated to its final size and written chunk by chunk"""
+
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self.size = size
+
+        with open(path, "w+b") as file:
+            file.truncate(size)
+            self.map = open_map(file, size, mmap.ACCESS_WRITE)
+
+        self.view = memoryview(self.map if self.map is not None else b"")
+
+    def __len__(self):
+        return ceil(self.size / CHUNK)
+
+    def chunk(self, seq: Seq) -> memoryview:
+        return self.view[seq * CHUNK : (seq + 1) * CHUNK]
+
+    def write(self, seq: Seq, data):
+        start = seq * CHUNK
+        end = min(start + len(data), self.size)
+        if 0 <= start < end:
+            self.view[start:end] = data[: end - start]
+
+    def checksum(self) -> str:
+        return checksum(self.map)
+
+    def close(self):
+        self.view.release()
+        if self.map is not None:
+            self.map.flush()
+            self.map.close()
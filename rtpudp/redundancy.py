@@ -0,0 +1,91 @@
+"""
+How many copies of each sequence to send in `profit`.
+
+With `buf` packets in flight and every copy lost with probability `p`, sending `x` copies of each
+sequence costs `x / (1 - buf * p^x)` transmissions per delivered packet: a round that loses any
+of its packets has to be repeated. That only depends on `buf` and `p`, so `p` is quantized to
+STEPS levels and every plan is computed once and cached, which makes the per packet decision a
+dictionary lookup.
+"""
+
+from functools import lru_cache
+from math import ceil, floor, log
+
+STEPS = 1000  # Loss rates are rounded to multiples of 1 / STEPS
+MAX_COPIES = 64
+
+
+def cost(buf: int, p: float, x: float) -> float:
+    """Expected transmissions per delivered packet, inf if the rounds never finish"""
+    lost = buf * p**x
+    if lost >= 1:
+        return float("inf")
+
+    return x / (1 - lost)
+
+
+def level(p: float) -> int:
+    return min(STEPS, max(0, round(p * STEPS)))
+
+
+@lru_cache(maxsize=1 << 14)
+def optimum(buf: int, level: int) -> float:
+    """Copies per sequence with the lowest cost for a loss rate of level / STEPS"""
+    p = level / STEPS
+    if p == 0 or buf <= 1:
+        return 1.0
+    if p >= 1:
+        return float(MAX_COPIES)
+
+    # Fewer copies than this lose a packet every round, past it the cost is unimodal
+    L = log(buf) / log(1 / p)
+    R = float(MAX_COPIES)
+    while R - L > 1e-3:
+        M1 = (2 * L + R) / 3
+        M2 = (L + 2 * R) / 3
+
+        if cost(buf, p, M1) < cost(buf, p, M2):
+            R = M2
+        else:
+            L = M1
+
+    return max(1.0, R)
+
+
+@lru_cache(maxsize=1 << 14)
+def whole_optimum(buf: int, level: int) -> int:
+    x = optimum(buf, level)
+    p = level / STEPS
+    return min((max(1, floor(x)), ceil(x)), key=lambda s: cost(buf, p, s))
+
+
+def find_s(buf: int, p: float) -> int:
+    """Whole number of copies per sequence with the lowest cost"""
+    return whole_optimum(buf, level(p))
+
+
+class RedundancySchedule:
+    """
+    Copies to send for each sequence in turn. By default that is always `find_s`, with `mixed`
+    it alternates between the whole numbers around the real optimum so that the copies sent
+    average out to it, the fractional part carrying over from one sequence to the next.
+    """
+
+    def __init__(self, buf: int, mixed: bool = False):
+        self.buf = buf
+        self.mixed = mixed
+        self.carry = 0.0
+
+    def copies(self, p: float) -> int:
+        if not self.mixed:
+            return whole_optimum(self.buf, level(p))
+
+        x = optimum(self.buf, level(p))
+        s = floor(x)
+
+        self.carry += x - s
+        if self.carry >= 1:
+            self.carry -= 1
+            return s + 1
+
+        return s
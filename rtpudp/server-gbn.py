@@ -1,108 +1,136 @@
-import queue
-import random
-import socket
-import struct
-import threading
-import time
+from argparse import ArgumentParser
+from asyncio import get_running_loop
+from logging import DEBUG, INFO, basicConfig, getLogger
+from random import Random
+
+from emulator import (
+    SCHEDULERS,
+    DRRScheduler,
+    LinkEmulator,
+    create_endpoint,
+    events,
+    parse_change,
+)
+from eventlog import add_arguments, start_from_arguments
+from tracing import Trace
+
+try:
+    from uvloop import run
+except ImportError:
+    from asyncio import run
+
+logger = getLogger(__name__)
 
 # Configuration
 SERVER_IP = "127.0.0.1"
 SERVER_PORT = 12000
-BUFFER_SIZE = 1024
 QUEUE_SIZE = 100  # B, Max buffer size
 PACKET_SERVICE_INTERVAL = (
     1 / 1000  # 1/C, Inverse of the link capacity, packet processing rate (FIFO)
 )
 DROP_PROBABILITY = 0.1  # PER, Probability of packet drop before entering the queue
 RTT = 0.1  # Round-trip time (RTT)
+SCHEDULER = "fifo"  # How the flows share the queue
+MODE = "gbn"  # Go-Back-N, or selective repeat with SACKs
+
+
+def log_stats(emulator: LinkEmulator):
+    stats = emulator.stats()
+    for flow in stats:
+        logger.info(
+            "%(addr)s: received %(received)d, dropped %(dropped)d, "
+            "overflowed %(overflowed)d, served %(served)d, "
+            "out of order %(out_of_order)d, recovered %(recovered)d, "
+            "delivered %(delivered)d in %(elapsed).3fs (%(goodput).1f packets/s)",
+            flow,
+        )
+
+    if len(stats) > 1:
+        logger.info(
+            "%d flows, delivered %d, aggregate goodput %.1f packets/s",
+            len(stats),
+            sum(flow["delivered"] for flow in stats),
+            sum(flow["goodput"] for flow in stats),
+        )
+
+
+async def main(args):
+    scheduler = SCHEDULERS[args.scheduler]()
+    if isinstance(scheduler, DRRScheduler):
+        scheduler.quantum = args.quantum
+
+    trace = None if args.trace is None else Trace()
+    transport, emulator = await create_endpoint(
+        lambda: LinkEmulator(
+            args.rtt,
+            args.service_interval,
+            args.drop_probability,
+            args.queue_size,
+            scheduler,
+            rng=Random(args.seed),
+            selective=args.mode == "sr",
+            output=args.output,
+            trace=trace,
+        ),
+        (args.ip, args.port),
+    )
 
-# Create UDP socket
-server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-server_socket.bind((SERVER_IP, SERVER_PORT))
-
-# Data structures
-received_packets = set()  # Track received sequence numbers
-delayed_packets = queue.PriorityQueue()  # Priority queue for delay handling
-processing_queue = queue.Queue(maxsize=QUEUE_SIZE)  # FIFO buffer
-base = -1  # Last in-order received packet
+    # With --port 0 this is the port the OS picked
+    ip, port = transport.get_extra_info("sockname")
+    print(f"Server listening on {ip}:{port}", flush=True)
 
-lock = threading.Lock()
+    for at, settings in args.change:
+        get_running_loop().call_later(at, emulator.change, settings)
 
+    try:
+        await get_running_loop().create_future()  # Run forever
+    finally:
+        transport.close()
+        log_stats(emulator)
 
-# Function to delay packets independently
-def delay_packet(seq_num, client_addr, recv_time):
-    expected_departure_time = recv_time + RTT
-    delayed_packets.put((expected_departure_time, seq_num, client_addr))
-    print(
-        f"Packet {seq_num} added to delay queue, expected at {expected_departure_time:.3f}",
-        flush=True,
-    )
+        if trace is not None:
+            trace.dump(args.trace)
+            logger.info("Wrote %d events to %s", len(trace), args.trace)
 
 
-# Function to process delayed packets and add to queue
-def process_delayed_packets():
-    global base
-    while True:
-        delay_time, seq_num, client_addr = delayed_packets.get()
-
-        # Ensure we don't process before its due time
-        sleep_time = max(0, delay_time - time.time())
-        time.sleep(sleep_time)
-
-        # Simulate random drop before entering queue
-        if random.random() < DROP_PROBABILITY:
-            print(f"Packet {seq_num} dropped before entering queue!", flush=True)
-            continue
-
-        # Add packet to processing queue (FIFO)
-        if not processing_queue.full():
-            processing_queue.put((seq_num, client_addr))
-            print(f"Packet {seq_num} added to queue at {time.time():.3f}", flush=True)
-        else:
-            print(f"Packet {seq_num} dropped due to full buffer!", flush=True)
-
-
-# Function to process queue and acknowledge packets
-def serve_packets():
-    global base
-    while True:
-        seq_num, client_addr = processing_queue.get()
-        with lock:
-            if seq_num == base + 1:
-                received_packets.add(seq_num)
-
-            # Update cumulative ACK base
-            while base + 1 in received_packets:
-                base += 1
-
-            # Send cumulative ACK
-            try:
-                ack_packet = struct.pack("!I", base)
-                server_socket.sendto(ack_packet, client_addr)
-                print(
-                    f"Processed Packet {seq_num}, Sent Cumulative ACK {base}",
-                    flush=True,
-                )
-            except struct.error:
-                print(f"Error: Unable to pack ACK for base {base}", flush=True)
-
-        time.sleep(PACKET_SERVICE_INTERVAL)  # Processing rate
-
-
-# Start packet processing threads
-threading.Thread(target=process_delayed_packets, daemon=True).start()
-threading.Thread(target=serve_packets, daemon=True).start()
-
-print(f"Server listening on {SERVER_IP}:{SERVER_PORT}", flush=True)
-
-while True:
-    packet, client_addr = server_socket.recvfrom(BUFFER_SIZE)
-    recv_time = time.time()
-    seq_num = struct.unpack("!I", packet)[0]
-
-    print(f"Received Packet {seq_num}, adding to delay line", flush=True)
-
-    # Delay packet independently
-    threading.Thread(
-        target=delay_packet, args=(seq_num, client_addr, recv_time), daemon=True
-    ).start()
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--ip", default=SERVER_IP)
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    parser.add_argument("--queue-size", type=int, default=QUEUE_SIZE)
+    parser.add_argument(
+        "--service-interval", type=float, default=PACKET_SERVICE_INTERVAL
+    )
+    parser.add_argument("--drop-probability", type=float, default=DROP_PROBABILITY)
+    parser.add_argument("--rtt", type=float, default=RTT)
+    parser.add_argument("--scheduler", choices=SCHEDULERS, default=SCHEDULER)
+    parser.add_argument("--quantum", type=int, default=1, help="packets per DRR turn")
+    parser.add_argument("--mode", choices=("gbn", "sr"), default=MODE)
+    parser.add_argument("--seed", type=int, help="seed the drops, to repeat a run")
+    parser.add_argument(
+        "--output",
+        help="write the payload of every flow here, {ip} and {port} are filled in",
+    )
+    parser.add_argument(
+        "--change",
+        type=parse_change,
+        action="append",
+        default=[],
+        help="SECONDS:NAME=VALUE,... changes the link that long after the start",
+    )
+    parser.add_argument("--trace", help="record every packet to this file")
+    parser.add_argument("--verbose", action="store_true", help="log every packet")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    basicConfig(
+        level=DEBUG if args.verbose else INFO,
+        format="%(asctime)s | %(levelname)-8s | %(message)s",
+    )
+    start_from_arguments(events, args)
+    try:
+        run(main(args))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        events.stop()
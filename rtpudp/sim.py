@@ -0,0 +1,289 @@
+"""
+Runs the sender in transport.py against the emulated link in virtual time.
+
+The event loop never sleeps: whenever nothing is ready to run its clock jumps straight to the next
+timer. The clients, the emulator and the datagrams between them all live on that loop, so a whole
+transfer takes as long as the Python code in it and the same seed always gives the same run.
+"""
+
+import selectors
+from argparse import ArgumentParser
+from asyncio import DatagramProtocol, DatagramTransport, Runner, SelectorEventLoop
+from asyncio import gather, get_running_loop, wait_for
+from collections.abc import Iterable
+from json import dumps
+from logging import ERROR
+from os.path import getsize
+from random import Random
+from statistics import mean, stdev
+from tempfile import TemporaryDirectory
+
+from client import configure_logging
+from emulator import SCHEDULERS, Address, LinkEmulator, parse_change
+from payload import Source
+from tracing import Trace
+from transport import RTPClientProtocol
+from transport import logger as client_logger
+
+SERVER_ADDR: Address = ("127.0.0.1", 12000)
+
+
+class VirtualSelector(selectors.DefaultSelector):
+    """Polls the real file descriptors without blocking and advances the clock instead"""
+
+    def __init__(self):
+        super().__init__()
+        self.now = 0.0
+
+    def select(self, timeout=None):
+        events = super().select(0)
+        if events:
+            return events
+
+        if timeout is None:
+            raise RuntimeError("Simulation stalled, nothing is scheduled")
+
+        self.now += timeout
+        return []
+
+
+class VirtualEventLoop(SelectorEventLoop):
+    def __init__(self):
+        self.selector = VirtualSelector()
+        super().__init__(self.selector)
+
+    def time(self):
+        return self.selector.now
+
+
+class Network:
+    """Delivers datagrams between the endpoints on the next loop iteration, in order"""
+
+    def __init__(self):
+        self.endpoints: dict[Address, DatagramProtocol] = {}
+
+    def bind(
+        self,
+        protocol: DatagramProtocol,
+        addr: Address,
+        remote_addr: Address | None = None,
+    ) -> "SimulatedTransport":
+        self.endpoints[addr] = protocol
+        transport = SimulatedTransport(self, protocol, addr, remote_addr)
+        protocol.connection_made(transport)
+        return transport
+
+    def deliver(self, data: bytes, src: Address, dst: Address):
+        protocol = self.endpoints.get(dst)
+        if protocol is not None:
+            get_running_loop().call_soon(protocol.datagram_received, data, src)
+
+
+class SimulatedTransport(DatagramTransport):
+    def __init__(
+        self,
+        network: Network,
+        protocol: DatagramProtocol,
+        addr: Address,
+        remote_addr: Address | None,
+    ):
+        super().__init__({"sockname": addr, "peername": remote_addr})
+        self.network = network
+        self.protocol = protocol
+        self.addr = addr
+        self.remote_addr = remote_addr
+        self.closing = False
+
+    def sendto(self, data, addr=None):
+        if not self.closing:
+            self.network.deliver(bytes(data), self.addr, addr or self.remote_addr)
+
+    def is_closing(self):
+        return self.closing
+
+    def close(self):
+        if self.closing:
+            return
+
+        self.closing = True
+        del self.network.endpoints[self.addr]
+        get_running_loop().call_soon(self.protocol.connection_lost, None)
+
+    def abort(self):
+        self.close()
+
+
+async def transfer(
+    emulator: LinkEmulator,
+    clients: int,
+    timeout: float | None = None,
+    changes: Iterable[tuple[float, dict]] = (),
+    fec_block: int = 0,
+    path: str | None = None,
+    trace: Trace | None = None,
+) -> dict:
+    loop = get_running_loop()
+    network = Network()
+    server = network.bind(emulator, SERVER_ADDR)
+
+    for at, settings in changes:
+        loop.call_later(at, emulator.change, settings)
+
+    started_at = loop.time()
+
+    lost = [loop.create_future() for _ in range(clients)]
+    sources = [None if path is None else Source(path) for _ in range(clients)]
+    protocols = [
+        RTPClientProtocol(on_con_lost, fec_block, trace=trace)  # type: ignore
+        for on_con_lost in lost
+    ]
+    for port, protocol in enumerate(protocols, 40000):
+        network.bind(protocol, ("127.0.0.1", port), SERVER_ADDR)
+
+    transfers = [
+        protocol.transfer(source) for protocol, source in zip(protocols, sources)
+    ]
+    await wait_for(gather(*transfers, *lost), timeout)
+    completion_time = loop.time() - started_at
+
+    result = {
+        "completion_time": completion_time,
+        "transmissions": sum(protocol.sent for protocol in protocols),
+    }
+
+    if path is not None:
+        sent = {source.checksum() for source in sources if source is not None}
+        received = [
+            flow.sink.checksum() if flow.sink is not None else None
+            for flow in emulator.flows.values()
+        ]
+        result["intact"] = all(checksum in sent for checksum in received)
+
+        for source in sources:
+            if source is not None:
+                source.close()
+
+    server.close()
+
+    stats = emulator.stats()
+    result["delivered"] = sum(flow["delivered"] for flow in stats)
+    result["flows"] = stats
+    return result
+
+
+def simulate(
+    rtt: float,
+    service_interval: float,
+    drop_probability: float,
+    queue_size: int,
+    seed: int = 0,
+    scheduler: str = "fifo",
+    selective: bool = False,
+    clients: int = 1,
+    timeout: float | None = None,
+    changes: Iterable[tuple[float, dict]] = (),
+    fec_block: int = 0,
+    path: str | None = None,
+    trace: Trace | None = None,
+) -> dict:
+    """
+    One transfer per client, all starting at once. Returns the totals and per flow stats, or
+    raises TimeoutError if they are not done within `timeout` virtual seconds. `changes` are
+    `(seconds, settings)` applied to the link that long after the start. `fec_block` is passed
+    on to the clients. With `path` every client sends that file and `intact` says whether what
+    the emulator received matches it. With `trace`, the clients and the emulator record into it.
+    """
+    with Runner(loop_factory=VirtualEventLoop) as runner, TemporaryDirectory() as output:
+        emulator = LinkEmulator(
+            rtt,
+            service_interval,
+            drop_probability,
+            queue_size,
+            SCHEDULERS[scheduler](),
+            rng=Random(seed),
+            selective=selective,
+            output=f"{output}/{{port}}",
+            trace=trace,
+        )
+        return runner.run(
+            transfer(emulator, clients, timeout, changes, fec_block, path, trace)
+        )
+
+
+def summarize(values: list[float]) -> dict:
+    return {
+        "mean": mean(values),
+        "stdev": stdev(values) if len(values) > 1 else 0.0,
+        "min": min(values),
+        "max": max(values),
+    }
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--rtt", type=float, default=0.1)
+    parser.add_argument("--service-interval", type=float, default=1 / 1000)
+    parser.add_argument("--drop-probability", type=float, default=0.1)
+    parser.add_argument("--queue-size", type=int, default=100)
+    parser.add_argument("--scheduler", choices=SCHEDULERS, default="fifo")
+    parser.add_argument("--mode", choices=("gbn", "sr"), default="gbn")
+    parser.add_argument("--clients", type=int, default=1)
+    parser.add_argument(
+        "--fec-block", type=int, default=0, help="parity every this many, with sr"
+    )
+    parser.add_argument(
+        "--change",
+        type=parse_change,
+        action="append",
+        default=[],
+        help="SECONDS:NAME=VALUE,... changes the link that long after the start",
+    )
+    parser.add_argument("--file", help="send the contents of this file")
+    parser.add_argument("--trace", help="record every packet of the first trial here")
+    parser.add_argument("--trials", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0, help="trial i uses seed + i")
+    parser.add_argument("--verbose", action="store_true", help="keep the client's logs")
+    args = parser.parse_args()
+
+    if args.verbose:
+        configure_logging()
+    else:
+        # Logging every packet would be most of what a simulated transfer costs
+        client_logger.setLevel(ERROR)
+
+    trace = None if args.trace is None else Trace()
+    results = [
+        simulate(
+            args.rtt,
+            args.service_interval,
+            args.drop_probability,
+            args.queue_size,
+            args.seed + trial,
+            args.scheduler,
+            args.mode == "sr",
+            args.clients,
+            changes=args.change,
+            fec_block=args.fec_block,
+            path=args.file,
+            trace=trace if trial == 0 else None,
+        )
+        for trial in range(args.trials)
+    ]
+
+    if trace is not None:
+        trace.dump(args.trace)
+
+    summary = {
+        "config": vars(args),
+        "completion_time": summarize([r["completion_time"] for r in results]),
+        "transmissions": summarize([r["transmissions"] for r in results]),
+        "delivered": summarize([r["delivered"] for r in results]),
+    }
+
+    if args.file is not None:
+        size = getsize(args.file) * args.clients
+        goodput = [size / r["completion_time"] / 1e6 for r in results]
+        summary["goodput"] = summarize(goodput)  # MB/s
+        summary["intact"] = all(r["intact"] for r in results)
+
+    print(dumps(summary))
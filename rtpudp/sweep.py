@@ -0,0 +1,248 @@
+"""
+Sweeps the client over a grid of link parameters and tabulates how it does.
+
+Every run gets its own emulator on a port picked by the OS and its own client, both as
+subprocesses, with as many runs at once as there are cores. With --backend sim the runs go
+through sim.py in a process pool instead, which is far faster but only as good as the model.
+"""
+
+import csv
+import sys
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from itertools import product
+from json import dumps, loads
+from math import sqrt
+from os import cpu_count
+from pathlib import Path
+from resource import RUSAGE_CHILDREN, getrusage
+from statistics import mean, stdev
+from subprocess import DEVNULL, PIPE, Popen, TimeoutExpired, run
+from tempfile import TemporaryDirectory
+
+HERE = Path(__file__).resolve().parent
+
+# Two sided 95% quantiles of Student's t distribution by degrees of freedom, normal beyond
+T95 = [12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228]
+T95 += [2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086]
+T95 += [2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042]
+
+
+@dataclass(frozen=True)
+class Point:
+    rtt: float
+    drop_probability: float
+    queue_size: int
+    service_interval: float
+    mode: str
+
+
+def cpu_time() -> float:
+    """Of the children waited for so far"""
+    usage = getrusage(RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def emulate(
+    client: str, point: Point, seed: int, timeout: float, python: str = sys.executable
+) -> dict | None:
+    """
+    Runs the client script with `python` against an emulator of its own, None if either fails.
+    Raises TimeoutExpired if the client is not done within `timeout` seconds. The CPU time of the
+    client is added as cpu_time, which only counts that client when runs go one at a time.
+    """
+    server = Popen(
+        [
+            sys.executable,
+            HERE / "server-gbn.py",
+            "--port=0",
+            f"--rtt={point.rtt}",
+            f"--drop-probability={point.drop_probability}",
+            f"--queue-size={point.queue_size}",
+            f"--service-interval={point.service_interval}",
+            f"--mode={point.mode}",
+            f"--seed={seed}",
+        ],
+        stdout=PIPE,
+        stderr=DEVNULL,
+        text=True,
+    )
+
+    try:
+        assert server.stdout is not None
+        port = server.stdout.readline().rsplit(":", 1)[1]
+
+        # The server is still running, so only the client is counted. Every client writes its
+        # log in its working directory
+        cpu_before = cpu_time()
+        with TemporaryDirectory() as cwd:
+            finished = run(
+                [python, HERE / client, f"--port={port}", "--json"],
+                cwd=cwd,
+                stdout=PIPE,
+                stderr=DEVNULL,
+                text=True,
+                timeout=timeout,
+            )
+
+        result = loads(finished.stdout)
+        result["cpu_time"] = cpu_time() - cpu_before
+        return result
+    except (IndexError, ValueError):
+        return None
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def run_emulated(point: Point, seed: int, timeout: float) -> dict | None:
+    try:
+        result = emulate("client.py", point, seed, timeout)
+    except TimeoutExpired:
+        return None
+
+    if result is not None:
+        del result["cpu_time"]  # Runs overlap here
+    return result
+
+
+def run_simulated(point: Point, seed: int, timeout: float) -> dict | None:
+    from sim import client_logger, simulate
+
+    client_logger.setLevel("ERROR")
+    try:
+        return simulate(
+            point.rtt,
+            point.service_interval,
+            point.drop_probability,
+            point.queue_size,
+            seed,
+            selective=point.mode == "sr",
+            timeout=timeout,
+        )
+    except TimeoutError:
+        return None
+
+
+def summarize(values: list[float]) -> tuple[float, float]:
+    """Mean and the half width of its 95% confidence interval"""
+    if len(values) < 2:
+        return (values[0] if values else float("nan")), float("nan")
+
+    df = len(values) - 1
+    t = T95[df - 1] if df <= len(T95) else 1.960
+    return mean(values), t * stdev(values) / sqrt(len(values))
+
+
+def tabulate(point: Point, results: list[dict | None]) -> dict:
+    done = [result for result in results if result is not None]
+
+    row = asdict(point)
+    row["runs"] = len(done)
+    row["failures"] = len(results) - len(done)
+    for metric, values in (
+        ("completion_time", [r["completion_time"] for r in done]),
+        ("transmissions", [r["transmissions"] for r in done]),
+        ("goodput", [r["delivered"] / r["completion_time"] for r in done]),
+        ("redundancy", [r["transmissions"] / r["delivered"] for r in done]),
+    ):
+        row[metric], row[f"{metric}_ci"] = summarize(values)
+
+    return row
+
+
+def print_table(rows: list[dict]):
+    columns = [
+        ("rtt", "{:g}"),
+        ("drop_probability", "{:g}"),
+        ("queue_size", "{:d}"),
+        ("service_interval", "{:g}"),
+        ("mode", "{}"),
+        ("runs", "{:d}"),
+        ("failures", "{:d}"),
+        ("completion_time", "{:.3f}"),
+        ("completion_time_ci", "±{:.3f}"),
+        ("transmissions", "{:.1f}"),
+        ("transmissions_ci", "±{:.1f}"),
+        ("goodput", "{:.1f}"),
+        ("goodput_ci", "±{:.1f}"),
+        ("redundancy", "{:.3f}"),
+        ("redundancy_ci", "±{:.3f}"),
+    ]
+
+    cells = [[name for name, _ in columns]]
+    cells += [[spec.format(row[name]) for name, spec in columns] for row in rows]
+    widths = [max(len(row[i]) for row in cells) for i in range(len(columns))]
+
+    for row in cells:
+        print("  ".join(cell.rjust(width) for cell, width in zip(row, widths)))
+
+
+def main(args):
+    points = [
+        Point(*values)
+        for values in product(
+            args.rtt,
+            args.drop_probability,
+            args.queue_size,
+            args.service_interval,
+            args.mode,
+        )
+    ]
+
+    if args.backend == "sim":
+        # CPU bound in this process, so one process per core
+        executor = ProcessPoolExecutor(args.workers)
+        runner = run_simulated
+    else:
+        # The runs are subprocesses already, these threads only wait for them
+        executor = ThreadPoolExecutor(args.workers)
+        runner = run_emulated
+
+    with executor:
+        futures = {
+            point: [
+                executor.submit(runner, point, args.seed + repeat, args.timeout)
+                for repeat in range(args.repeats)
+            ]
+            for point in points
+        }
+
+        rows = []
+        for point, results in futures.items():
+            results = [future.result() for future in results]
+            rows.append(tabulate(point, results))
+
+            if args.raw is not None:
+                with open(args.raw, "a") as file:
+                    for result in results:
+                        record = {"point": asdict(point), "result": result}
+                        print(dumps(record), file=file)
+
+    print_table(rows)
+
+    if args.output is not None:
+        with open(args.output, "w", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--rtt", type=float, nargs="+", default=[0.1])
+    parser.add_argument("--drop-probability", type=float, nargs="+", default=[0.1])
+    parser.add_argument("--queue-size", type=int, nargs="+", default=[100])
+    parser.add_argument(
+        "--service-interval", type=float, nargs="+", default=[1 / 1000]
+    )
+    parser.add_argument("--mode", choices=("gbn", "sr"), nargs="+", default=["gbn"])
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--backend", choices=("emulator", "sim"), default="emulator")
+    parser.add_argument("--workers", type=int, default=cpu_count())
+    parser.add_argument("--timeout", type=float, default=120, help="seconds per run")
+    parser.add_argument("--seed", type=int, default=0, help="repeat i uses seed + i")
+    parser.add_argument("--output", help="CSV file for the table")
+    parser.add_argument("--raw", help="file to append every run to as JSON lines")
+    main(parser.parse_args())
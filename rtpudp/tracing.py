@@ -0,0 +1,84 @@
+"""
+Packet traces of a run, every send and ACK of the client and every packet the emulator handles.
+
+Events go into typed columns preallocated as arrays, which grow by doubling, so recording one is
+a handful of stores rather than a tuple on a list. A dump is a short header followed by each
+column as raw little endian values, which analyze.py maps straight into NumPy arrays.
+"""
+
+import sys
+from array import array
+from enum import IntEnum
+from struct import Struct
+
+MAGIC = b"RTPT"
+VERSION = 1
+HEADER = Struct("<4sB3xQ")  # Magic, version, number of events
+
+# Name, array typecode and NumPy dtype of each column, widest first to keep them aligned
+COLUMNS = (
+    ("time", "d", "<f8"),  # Loop time, the same clock for the client and the emulator
+    ("seq", "q", "<i8"),  # As on the wire, parity packets have the top bit set
+    ("value", "i", "<i4"),  # Depends on the kind
+    ("flow", "H", "<u2"),  # The client's port
+    ("kind", "B", "u1"),
+)
+
+
+class Kind(IntEnum):
+    # Client, `seq` is what was sent or the cumulative ACK
+    SEND = 0
+    PARITY = 1  # `value` is the number of packets in the block
+    ACK = 2
+
+    # Emulator, `value` is the queue length after the event where it is given
+    ARRIVE = 3
+    DROP = 4
+    OVERFLOW = 5
+    QUEUE = 6
+    SERVE = 7
+    RECOVER = 8
+
+
+class Trace:
+    def __init__(self, capacity: int = 1 << 16):
+        self.count = 0
+        self.capacity = capacity
+
+        self.time = array("d", bytes(8 * capacity))
+        self.seq = array("q", bytes(8 * capacity))
+        self.value = array("i", bytes(4 * capacity))
+        self.flow = array("H", bytes(2 * capacity))
+        self.kind = array("B", bytes(capacity))
+
+    def __len__(self):
+        return self.count
+
+    def record(self, time: float, kind: Kind, flow: int, seq: int, value: int = 0):
+        n = self.count
+        if n == self.capacity:
+            self.grow()
+
+        self.time[n] = time
+        self.seq[n] = seq
+        self.value[n] = value
+        self.flow[n] = flow
+        self.kind[n] = kind
+        self.count = n + 1
+
+    def grow(self):
+        for name, _, _ in COLUMNS:
+            column = getattr(self, name)
+            column.frombytes(bytes(column.itemsize * self.capacity))
+
+        self.capacity *= 2
+
+    def dump(self, path: str):
+        with open(path, "wb") as file:
+            file.write(HEADER.pack(MAGIC, VERSION, self.count))
+            for name, _, _ in COLUMNS:
+                column = getattr(self, name)[: self.count]
+                if sys.byteorder != "little":
+                    column.byteswap()
+
+                column.tofile(file)
@@ -0,0 +1,568 @@
+"""
+The sender as a library, for any number of transfers on one event loop.
+
+    connection = await open_connection("127.0.0.1", 12000)
+    try:
+        result = await connection.send_stream(Source(path))
+    finally:
+        await connection.close()
+
+Importing it sets nothing up: the logger only has a NullHandler and the per packet events are logged as
+they happen until the caller starts `events`. client.py is the command line around it.
+"""
+
+from asyncio import Event, get_running_loop, sleep, wait_for
+from asyncio.futures import Future
+from asyncio.protocols import DatagramProtocol
+from asyncio.transports import DatagramTransport
+from logging import WARNING, NullHandler, getLogger
+from math import ceil
+from socket import AF_INET, SOCK_DGRAM, socket
+from struct import pack, unpack
+from typing import Literal, TypeAlias
+
+from acks import AckHistory
+from estimators import LinkEstimator, WindowEstimator
+from eventlog import EventLog
+from pacer import Datagram, Pacer, sendmmsg
+from payload import CHUNK, Source
+from redundancy import RedundancySchedule
+from tracing import Kind, Trace
+
+logger = getLogger(__name__)
+logger.addHandler(NullHandler())  # Or warnings go to stderr when the caller set up nothing
+
+# Logged for every packet, kept off the hot paths once the event log is started
+events = EventLog(logger)
+log_sending = events.event("sending", "Sending: %d with count: %d and drop: %f")
+log_resending = events.event("resending", "Resending: %d")
+log_sent = events.event("sent", "Sent: %d")
+log_parity = events.event("parity", "Sent parity: %d+%d")
+log_received = events.event("received", "Received: %s")
+log_acknowledged = events.event(
+    "acknowledged", "Attempted to send acknowledged packet: %d", WARNING
+)
+
+Seq: TypeAlias = int
+Timestamp: TypeAlias = float
+Block: TypeAlias = tuple[Seq, int]  # First sequence and length
+
+# Go-back-N, selective repeat, or whichever the server's ACKs say it supports
+Strategy: TypeAlias = Literal["auto", "gbn", "sr"]
+STRATEGIES: tuple[Strategy, ...] = ("auto", "gbn", "sr")
+
+COUNT = 1001  # Sequences in a transfer without a source
+
+ALPHA = 0.1
+
+PARITY = 1 << 31  # Marks parity packets, as in emulator.py
+
+
+class RTPClientProtocol(DatagramProtocol):
+    def __init__(
+        self,
+        on_con_lost: Future[bool],
+        fec_block: int = 0,
+        sock: socket | None = None,
+        trace: Trace | None = None,
+        strategy: Strategy = "auto",
+    ):
+        self.on_con_lost = on_con_lost
+        self.transport: DatagramTransport | None = None
+        self.sock = sock  # The transport's, for scatter gather sends
+
+        # Every send and ACK goes in the trace, under the local port
+        self.trace = trace
+        self.port = 0
+
+        # Every sequence carries a chunk of the file, without one they are all that is sent
+        self.source: Source | None = None
+        self.final_seq: Seq = COUNT - 1
+
+        # The loop's clock, so that the simulator can run everything in virtual time
+        self.time = get_running_loop().time
+
+        self.acks = AckHistory()
+        # Unpaced while probing, the stages that follow set the rate
+        self.pacer: Pacer[Seq | Block] = Pacer(self.send_batch, quantum=2)
+
+        self.ack1 = Event()
+        self.ack2 = Event()
+
+        # Only servers in selective repeat mode send SACKs
+        self.selective = False
+        self.sacks = 0  # Bit i set means last ack + 2 + i was received
+        self.sack_window = 0
+
+        self.strategy = strategy
+
+        # With selective repeat, one parity packet after every this many new sequences
+        self.fec_block = fec_block
+
+        self.estimator = LinkEstimator()
+
+        self.sent = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.port = transport.get_extra_info("sockname")[1]
+        logger.info("Established connection")
+
+    async def transfer(self, source: Source | None = None, count: int = COUNT):
+        """
+        Sends `count` sequences, or one per chunk of `source`, until the last one is ACKed and
+        closes the connection. The server tells flows apart by their address, so a connection
+        carries one transfer.
+        """
+        assert self.transport is not None
+
+        self.source = source
+        self.final_seq = (count if source is None else len(source)) - 1
+
+        try:
+            await self.blast_off()
+        finally:
+            self.pacer.close()
+            self.transport.close()
+
+    async def blast_off(self):
+        assert self.transport is not None
+
+        start = self.time()
+        # If we are unable to get rtt, then no packet is getting through
+        rtt, prc = await self.estimate_latency()
+        while rtt == float("inf"):
+            rtt, prc = await self.estimate_latency()
+
+        logger.info("Estimated rtt: %f, prc: %f", rtt, prc)
+        if prc == float("inf"):
+            # TODO: Handle high packet loss
+            return
+
+        buf = await self.estimate_buffer(rtt, prc)
+        logger.info("Estimated buf: %d", buf)
+
+        # A selective repeat server sends the cumulative ACKs go-back-N needs as well
+        selective = self.selective if self.strategy == "auto" else self.strategy == "sr"
+        if selective and not self.selective:
+            raise ConnectionError("Selective repeat needs a server that sends SACKs")
+
+        if selective:
+            await self.profit_selective(rtt, prc, buf)
+        else:
+            await self.profit(rtt, prc, buf)
+
+        end = self.time()
+        logger.info("Sent all packets: %f, transmissions: %d", end - start, self.sent)
+
+    async def estimate_latency(self):
+        self.ack1.clear()
+        self.ack2.clear()
+
+        TIMEOUT = 10
+        PACKET_SEND_COUNT = 8
+
+        started_at = self.time()
+
+        seq = self.acks.seq
+        self.acks.mark()
+        for _ in range(PACKET_SEND_COUNT):
+            self.pacer.push(seq + 1)
+
+        await wait_for(self.ack1.wait(), TIMEOUT)
+        if self.acks.count < 1:
+            logger.error("Extremely high packet loss detected")
+            return float("inf"), float("inf")
+
+        ack1 = self.acks.since_mark(0)[0]
+        rtt = ack1 - started_at
+
+        await wait_for(self.ack2.wait(), TIMEOUT)
+        if self.acks.count < 2:
+            logger.error("High packet loss detected")
+            return rtt, float("inf")
+
+        # Could be higher than actual processing time if packet loss is non-zero
+        ack2 = self.acks.since_mark(1)[0]
+        prc = ack2 - ack1
+
+        # Clear out server buffer
+        in_buffer = PACKET_SEND_COUNT - self.acks.count
+        await sleep(in_buffer * prc * (1 + ALPHA))
+
+        prc = self.acks.mean_gap
+        return rtt, prc
+
+    async def estimate_buffer(self, rtt: float, prc: float):
+        """
+        Probes until the buffer comes out at least MIN_BUFFER_SIZE packets. Less than that is a
+        probe that failed, as when other flows fill the queue while it runs, and after PROBES of
+        those the buffer is taken to be what it takes to send once every service time. The
+        pacing window shrinks from there if the queue is shared.
+        """
+        PROBES = 3
+        MIN_BUFFER_SIZE = 4
+
+        required = ceil((rtt + prc) / prc)
+        for _ in range(PROBES):
+            buffer_size = await self.probe_buffer(rtt, prc)
+            if buffer_size >= min(MIN_BUFFER_SIZE, required):
+                return buffer_size
+
+            logger.warning("Probed buf: %d, probing again", buffer_size)
+
+        return required
+
+    async def probe_buffer(self, rtt: float, prc: float) -> int:
+        BURST_DROP = 8
+
+        REQUIRED_BUFFER_SIZE = ceil((rtt + prc) / prc)
+
+        # Assuming that drop rate < 25%
+        PACKET_SEND_COUNT = ceil(3 * REQUIRED_BUFFER_SIZE / 2)
+
+        sel = self.acks.seq
+        # A gap that long means the packets in between were dropped
+        self.acks.mark(burst_gap=BURST_DROP * prc)
+        for seq in range(sel + 1, sel + PACKET_SEND_COUNT + 1):
+            self.pacer.push(seq)
+
+        # Clear out server buffer
+        await sleep((rtt + PACKET_SEND_COUNT * prc) * (1 + ALPHA))
+
+        end = self.time()
+
+        acks = self.acks
+        buffer_size = min(REQUIRED_BUFFER_SIZE, acks.count, acks.shortest_burst)
+
+        if end - acks.at >= BURST_DROP * prc:
+            buffer_size = min(buffer_size, acks.burst)
+
+        return int(buffer_size)
+
+    def link(self, rtt: float, prc: float) -> tuple[float, float]:
+        """The latest rtt and service time estimates, the probed ones until there are samples"""
+        estimated_rtt = self.estimator.rtt.min
+        estimated_prc = self.estimator.service.interval
+        return (
+            rtt if estimated_rtt == float("inf") else estimated_rtt,
+            prc if estimated_prc == float("inf") else estimated_prc,
+        )
+
+    async def profit(self, rtt: float, prc: float, buf: int):
+        T0 = self.final_seq
+
+        """
+        m0 = T0 * (p^s)
+        T1 = T0 + m0 * buf
+        m1 = T1 * (p^s)
+           = T0 * (1 + buf * (p^s)) * (p^s)
+           = T0 * (p^s + buf * p^2s)
+           = T0 * ((buf * p^s) + (buf * p^s)^2) / buf
+        TI = T0 / (1 - buf * p^s)
+        total = TI * s * prc
+        """
+
+        seq = self.acks.seq
+        schedule = RedundancySchedule(buf)
+        window = WindowEstimator(buf)
+        s = 1
+
+        # Probing overflowed the queue on purpose and has waited out its ACKs
+        self.estimator.loss.forget()
+
+        last_correct = self.time()
+        while self.acks.seq < T0:
+            # Follow the link as it changes
+            rtt, prc = self.link(rtt, prc)
+            window.update(self.estimator.rtt, prc)
+            schedule.buf = round(window.value)
+            interval = max(prc, (rtt + prc) / window.value)
+            p = self.estimator.loss.rate
+            # ACKs can take longer than the base RTT while the queue is full, a rewound sequence
+            # comes back after the smoothed one. Waiting out the whole timeout only wastes sends
+            late = rtt * (1 + ALPHA)
+            if self.estimator.rtt.smoothed != float("inf"):
+                late = max(late, self.estimator.rtt.smoothed * (1 + ALPHA))
+
+            previous, s = s, schedule.copies(p)
+            seq += 1
+
+            self.pacer.rate = 1 / (interval * (1 + ALPHA))
+
+            log_sending(seq, s, p)
+            for _ in range(s):
+                self.pacer.push(seq)
+                # The copies of the previous sequence are duplicate ACKs too
+                if (
+                    self.time() - last_correct >= late
+                    and self.acks.duplicates > max(s, previous)
+                ):
+                    seq = self.acks.seq
+                    last_correct = self.time()
+                    break
+
+                # Paced in pairs so that the ACK spacing shows the service time
+                if not self.pacer.due():
+                    await self.pacer.drain()
+
+    async def profit_selective(self, rtt: float, prc: float, buf: int):
+        """
+        Selective repeat: every sequence is sent once and only the holes in the SACKs are resent.
+        The server serves each flow in order, so a packet is lost once a packet sent after it has
+        been received, or once it has gone unanswered for longer than the queue can delay it.
+
+        With `fec_block` every block of that many new sequences is followed by the XOR of them,
+        from which the server rebuilds any one of them that was lost. Then a hole is only lost
+        once something sent after the parity of its block has been received.
+        """
+        T0 = self.final_seq
+
+        sent_at: dict[Seq, Timestamp] = {}  # In order of first transmission
+        seq = self.acks.seq
+
+        start = seq + 1  # Of the first block
+        k = self.fec_block or 1
+        window = WindowEstimator(buf)
+
+        while self.acks.seq < T0:
+            base = self.acks.seq
+            seq = max(seq, base)  # Stragglers from the probing stages can move base ahead
+            while sent_at and next(iter(sent_at)) <= base:
+                del sent_at[next(iter(sent_at))]
+
+            now = self.time()
+            rtt, prc = self.link(rtt, prc)
+            interval = max(prc, (rtt + prc) / window.value)
+            self.pacer.rate = 1 / (interval * (1 + ALPHA))
+            # Stamped when pushed, a packet can wait out a quantum in the pacer before it is sent.
+            # The probed buffer bounds the queueing delay even while the window is smaller
+            queue = max(buf, window.value)
+            timeout = (rtt + queue * prc) * (1 + ALPHA) + self.pacer.quantum / self.pacer.rate
+
+            highest = base + 1 + self.sacks.bit_length()
+            latest = sent_at.get(highest, -float("inf"))
+
+            # Bit i set means base + 1 + i has not been received, only up to the highest SACK
+            last = min(seq, highest)
+            missing = ~(self.sacks << 1) & ((1 << (last - base)) - 1)
+
+            hole = None
+            while missing:
+                lowest = missing & -missing
+                missing ^= lowest
+
+                candidate = base + lowest.bit_length()
+                block_end = start + ((candidate - start) // k + 1) * k - 1
+                sent = sent_at.get(candidate, -float("inf"))
+                if (sent < latest and highest > block_end) or now - sent >= timeout:
+                    hole = candidate
+                    break
+
+            # Nothing past the highest SACK has been resent, so the first one is the oldest
+            if hole is None and last < seq and now - sent_at[last + 1] >= timeout:
+                hole = last + 1
+
+            parity = None
+            if hole is not None:
+                log_resending(hole)
+            elif seq < T0 and seq < base + self.sack_window:
+                seq += 1
+                hole = seq
+
+                if self.fec_block and ((seq - start + 1) % k == 0 or seq == T0):
+                    first = seq - (seq - start) % k
+                    parity = (first, seq - first + 1)
+
+            if hole is not None:
+                window.update(self.estimator.rtt, prc)
+                sent_at[hole] = now
+                self.pacer.push(hole)
+                if parity is not None:
+                    self.pacer.push(parity)
+
+                # Paced in pairs so that the ACK spacing shows the service time
+                if self.pacer.due():
+                    continue
+
+            if len(self.pacer):
+                await self.pacer.drain()
+            else:
+                await sleep(interval * (1 + ALPHA))
+
+    def datagram_received(self, data: bytes, _):
+        assert len(data) >= 4  # HOW?!
+
+        received_at: Timestamp = self.time()
+        seq: Seq = unpack("!I", data[:4])[0]
+
+        if len(data) > 4:
+            self.selective = True
+            self.sacks = int.from_bytes(data[4:], "little")
+            self.sack_window = (len(data) - 4) * 8
+
+        self.acks.append(received_at, seq)
+        self.estimator.on_ack(seq, received_at)
+        if self.trace is not None:
+            self.trace.record(received_at, Kind.ACK, self.port, seq)
+
+        if self.acks.count == 1:
+            self.ack1.set()
+        elif self.acks.count == 2:
+            self.ack2.set()
+
+        log_received(seq)
+
+    def error_received(self, exc):
+        logger.exception("Error received:", exc_info=exc)
+
+    def connection_lost(self, exc):
+        logger.warning("Connection closed")
+        self.pacer.close()
+        self.on_con_lost.set_result(True)
+
+    def send_batch(self, packets: list[Seq | Block]):
+        """Everything the pacer has due at once, in as few system calls as there can be"""
+        now = self.time()
+
+        trace = self.trace
+
+        datagrams = []
+        for packet in packets:
+            if isinstance(packet, tuple):
+                datagrams.append(self.parity(*packet))
+                self.estimator.on_parity(now)
+                if trace is not None:
+                    first, count = packet
+                    trace.record(now, Kind.PARITY, self.port, PARITY | first, count)
+            else:
+                last_ack = self.acks.seq
+                if last_ack + 1 > packet:
+                    log_acknowledged(packet)
+                    packet = last_ack + 1
+
+                datagrams.append(self.packet(packet))
+                self.estimator.on_send(packet, now)
+                if trace is not None:
+                    trace.record(now, Kind.SEND, self.port, packet)
+
+        self.sent += len(packets)
+        self.sendmmsg(datagrams)
+
+    def packet(self, seq: Seq) -> Datagram:
+        log_sent(seq)
+
+        header = pack("!I", seq)
+        if self.source is None:
+            return [header]
+
+        return [header, self.source.header, self.source.chunk(seq)]
+
+    def parity(self, first: Seq, count: int) -> Datagram:
+        # The XOR of the packets in the block, which are nothing but their sequences
+        parity = 0
+        for seq in range(first, first + count):
+            parity ^= seq
+
+        log_parity(first, count)
+
+        header = pack("!IBI", PARITY | first, count, parity)
+        if self.source is None:
+            return [header]
+
+        # Little endian, so that a short last chunk is padded with zeros at its end
+        chunks = 0
+        for seq in range(first, first + count):
+            chunks ^= int.from_bytes(self.source.chunk(seq), "little")
+        return [header, chunks.to_bytes(CHUNK, "little")]
+
+    def sendmmsg(self, datagrams: list[Datagram]):
+        """
+        Sends the datagrams, fewer than a `sendmmsg` batch straight from the map and a batch
+        joined into one buffer first, see `pacer.sendmmsg`
+        """
+        assert self.transport is not None
+
+        if self.sock is None:
+            for buffers in datagrams:
+                self.transport.sendto(b"".join(buffers))
+            return
+
+        try:
+            # What a full socket buffer leaves unsent is the same as a drop on the wire
+            sendmmsg(self.sock, datagrams)
+        except OSError as exc:
+            self.error_received(exc)
+
+
+class Connection:
+    """A connected socket to the server and the protocol on it, from `open_connection`"""
+
+    def __init__(self, transport: DatagramTransport, protocol: RTPClientProtocol):
+        self.transport = transport
+        self.protocol = protocol
+
+    async def send_stream(
+        self, source: Source | None = None, count: int = COUNT
+    ) -> dict:
+        """
+        Sends `count` sequences, or the chunks of `source`, and returns how it went, what
+        client.py prints with --json. The connection is closed afterwards, the source is left
+        to the caller.
+        """
+        protocol = self.protocol
+        if protocol.sent:
+            raise RuntimeError("A connection carries one transfer")
+
+        loop = get_running_loop()
+        started_at = loop.time()
+        await protocol.transfer(source, count)
+        completion_time = loop.time() - started_at
+
+        result = {
+            "completion_time": completion_time,
+            "transmissions": protocol.sent,
+            "delivered": protocol.acks.seq + 1,
+        }
+
+        if source is not None:
+            result["bytes"] = source.size
+            result["goodput"] = source.size / completion_time / 1e6  # MB/s
+            result["sha256"] = source.checksum()
+
+        return result
+
+    async def close(self):
+        self.transport.close()
+        await self.protocol.on_con_lost
+
+
+async def open_connection(
+    host: str = "127.0.0.1",
+    port: int = 12000,
+    fec_block: int = 0,
+    strategy: Strategy = "auto",
+    trace: Trace | None = None,
+) -> Connection:
+    """
+    Connects to the server at `host` and `port`, nothing is sent until `send_stream`. Any number
+    of connections can share the loop and a `trace`, which records each under its local port.
+    """
+    loop = get_running_loop()
+
+    sock = socket(AF_INET, SOCK_DGRAM)
+    sock.setblocking(False)
+    try:
+        # Resolves the host without blocking the loop
+        await loop.sock_connect(sock, (host, port))
+    except BaseException:
+        sock.close()
+        raise
+
+    on_con_lost: Future[bool] = loop.create_future()
+    transport, protocol = await loop.create_datagram_endpoint(
+        lambda: RTPClientProtocol(on_con_lost, fec_block, sock, trace, strategy),
+        sock=sock,
+    )
+
+    return Connection(transport, protocol)
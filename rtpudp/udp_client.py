@@ -7,12 +7,24 @@ Authors:
     https://github.com/nandhagk/EE5150/tree/main/rtpudp
 """
 
+import logging
 import math
 import queue
 import socket
 import struct
 import threading
 import time
+from argparse import ArgumentParser
+from json import dumps
+
+from eventlog import EventLog, add_arguments, start_from_arguments
+
+logger = logging.getLogger(__name__)
+
+# Logged for every packet, kept off the sending and listening threads by the event log
+events = EventLog(logger)
+log_ack = events.event("ack", "RECEIVED ACK %d")
+log_step = events.event("step", "%f %d %f %d %d")
 
 type Seq = int
 type Timestamp = float
@@ -23,11 +35,12 @@ type Ack = tuple[Timestamp, Seq]
 
 
 class UDPClient:
-    def __init__(self, address: tuple[str, int]):
+    def __init__(self, address: tuple[str, int], count: int = 1001):
         self.__sock = socket.socket(
             socket.AddressFamily.AF_INET, socket.SocketKind.SOCK_DGRAM
         )
         self.__address = address
+        self.final_seq: Seq = count - 1
         self.__is_running = False
 
         self.__listen_thread: threading.Thread
@@ -45,6 +58,7 @@ class UDPClient:
         self.start_polling: bool = False
         self.total_sends = 0
         self.total_recs = 0
+        self.sent = 0  # Every transmission, total_sends only counts those of stage 3
 
     def _service_loop(self):
         """
@@ -62,6 +76,7 @@ class UDPClient:
                 self.__sock.sendto(
                     struct.pack("!I", max(self.last_ack + 1, seq)), self.__address
                 )
+                self.sent += 1
 
                 if self.start_polling:
                     self.total_sends += 1
@@ -86,14 +101,14 @@ class UDPClient:
                     self.total_recs += 1
 
                 self.last_ack = seq
-                print("RECEIVED ACK", seq, flush=True)
+                log_ack(seq)
                 self.acks.append((time.time(), seq))
 
                 if len(self.acks) == 2:
                     self.two_message_arrive_event.set()
 
             except socket.error as e:  # If the socket closed abruptly
-                print(e)  # TODO: Figure out expected behaviour here, flush=True!
+                logger.error("%s", e)  # TODO: Figure out expected behaviour here
                 self.stop()
 
     def stop(self):
@@ -106,8 +121,8 @@ class UDPClient:
 
         try:
             self.__sock.shutdown(socket.SHUT_RDWR)
-        except Exception:
-            print("HI", flush=True)
+        except OSError:
+            pass  # Not connected, there is only the listening thread to wake up
 
         self.__sock.close()
 
@@ -172,13 +187,13 @@ class UDPClient:
 
         NOTE: We expect the server queue to be empty!
         """
-        print("ESTIMATING", rtt, processing_delay, flush=True)
+        logger.info("ESTIMATING %f %f", rtt, processing_delay)
 
         REQUIRED_BUFFER_SIZE = math.ceil((rtt + processing_delay) / processing_delay)
         """The buffer size required by us (More about this in `self.profit`)"""
 
         PACKET_SEND_COUNT = 2 * REQUIRED_BUFFER_SIZE
-        print(REQUIRED_BUFFER_SIZE, PACKET_SEND_COUNT, flush=True)
+        logger.info("%d %d", REQUIRED_BUFFER_SIZE, PACKET_SEND_COUNT)
         # To get a decent idea of the buffer size, we need to fill it to the max
         # Since we are happy with the REQUIRED_BUFFER_SIZE, we only need calculate till that point
         # But to account for any minute errors, we go uptil 1.5 * the required
@@ -226,7 +241,7 @@ class UDPClient:
 
         Everything is known, our hard work has paid off. Tis now the time to take advantage of our knowledge
         """
-        print("PROFIT", processing_delay, buffer_size, flush=True)
+        logger.info("PROFIT %f %d", processing_delay, buffer_size)
 
         # Ideally we want to send messages every processing delay
         # (Sending any faster doesn't really provide any advantages)
@@ -241,7 +256,7 @@ class UDPClient:
         start_time = time.time()
 
         seq = self.last_ack + 1
-        while self.last_ack < 1000:
+        while self.last_ack < self.final_seq:
             # Send the remaining packets
 
             # TODO: Account for race conditions!
@@ -250,7 +265,7 @@ class UDPClient:
             #     and self.acks[-1][1] == self.acks[-3][1]
             #     and self.acks[-1][1] == self.acks[-2][1]
             # ):
-            #     print("TRIPLE ACK", self.acks[-1][1], flush=True)
+            #     logger.info("TRIPLE ACK %d", self.acks[-1][1])
             #     # Whenever we perceive a triple ack we reset our sequence number
             #     seq = self.acks[-1][1] + 1
             #     time.sleep(rtt * 1.05)  # Let the buffer clear
@@ -271,7 +286,7 @@ class UDPClient:
             #     math.exp(drop_chance / (1 - min(drop_chance, 0.9))) * 6 - 5
             # )
 
-            print(
+            log_step(
                 drop_chance,
                 send_count,
                 send_count * (1 - drop_chance),
@@ -292,11 +307,11 @@ class UDPClient:
         """
         # Stage 1:
         rtt, proc = self.estimate_delays()
-        print(rtt, proc, flush=True)
+        logger.info("%f %f", rtt, proc)
 
         # Stage 2:
         buffer_size = self.estimate_buffer(rtt, proc)
-        print(buffer_size, flush=True)
+        logger.info("%d", buffer_size)
 
         # Stage 3:
         self.profit(rtt, proc, buffer_size)
@@ -304,16 +319,38 @@ class UDPClient:
         return True
 
 
-client = UDPClient(("127.0.0.1", 12000))
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=12000)
+    parser.add_argument("--count", type=int, default=1001, help="sequences to send")
+    parser.add_argument("--json", action="store_true", help="print the result as JSON")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG, format="%(message)s")
+    start_from_arguments(events, args)
 
-t0 = time.time()
-success = client.run()
+    client = UDPClient((args.host, args.port), args.count)
 
-if success:
+    t0 = time.time()
+    success = client.run()
     t1 = time.time()
-    print("TIME TAKEN!", t1 - t0, flush=True)
-else:
-    print("SOMETHING VERY BAD HAPPENED!", flush=True)
-# Measure here ig :)
 
-client.cleanup()
+    if success:
+        logger.info("TIME TAKEN! %f", t1 - t0)
+    else:
+        logger.error("SOMETHING VERY BAD HAPPENED!")
+    # Measure here ig :)
+
+    client.cleanup()
+    events.stop()
+
+    if args.json:
+        # The same fields as client.py prints
+        result = {
+            "completion_time": t1 - t0,
+            "transmissions": client.sent,
+            "delivered": client.last_ack + 1,
+        }
+        print(dumps(result), flush=True)